@@ -0,0 +1,66 @@
+import argparse
+import asyncio
+import datetime
+import os
+import tempfile
+import time
+
+# Конфиг читается при импорте, для бенчмарка бот и каналы не нужны
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+os.environ.setdefault('CHANNEL_USERNAMES', 'benchmark')
+os.environ.setdefault('ADMIN_IDS', '0')
+os.environ.setdefault('DATABASE_SLOW_QUERY_MS', '60000')
+
+from database.database_queries import Database
+
+
+async def issue(database, pairs):
+    started = time.perf_counter()
+    tickets = await asyncio.gather(*[
+        database.create_ticket(user_id, concert_id) for user_id, concert_id in pairs])
+    return tickets, time.perf_counter() - started
+
+
+def report(title, count, elapsed):
+    print(f'{title}: {count} запросов за {elapsed:.3f} с, {count / elapsed:.0f} запросов/с')
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Пропускная способность выдачи билетов')
+    parser.add_argument('--url', default=None,
+                        help='DATABASE_URL, по умолчанию временная SQLite-база')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--execution-mode', default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        url = args.url or f'sqlite:///{os.path.join(directory, "benchmark.db")}'
+        database = Database(url, args.execution_mode)
+        try:
+            await database.startup()
+            concert = await database.create_concert(
+                'Benchmark', '', datetime.datetime.now() + datetime.timedelta(days=1), '', [])
+            users = [await database.get_or_create_user(10 ** 9 + i, f'bench{i}', f'Bench {i}')
+                     for i in range(args.users)]
+
+            # Двойные нажатия: все запросы от одного пользователя на один концерт
+            tickets, elapsed = await issue(
+                database, [(users[0].id, concert.id)] * args.requests)
+            report('Один пользователь', args.requests, elapsed)
+            codes = {ticket['code'] for ticket in tickets}
+            print(f'  выдано уникальных билетов: {len(codes)} (ожидается 1)')
+
+            # Повторная выдача уже существующих билетов вперемешку с новыми
+            pairs = [(users[i % args.users].id, concert.id) for i in range(args.requests)]
+            tickets, elapsed = await issue(database, pairs)
+            report(f'{args.users} пользователей', args.requests, elapsed)
+            codes = {ticket['code'] for ticket in tickets}
+            print(f'  выдано уникальных билетов: {len(codes)} (ожидается {min(args.users, args.requests)})')
+            print(f'Кодов выдано в обход пула: {database.ticket_codes.fallbacks}')
+        finally:
+            await database.shutdown()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
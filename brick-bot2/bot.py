@@ -11,12 +11,14 @@ from aiogram.filters import Command
 
 from config import config
 from database.database_queries import database
+from database.ticket_codes import normalize_code
 import keyboards.reply_keyboards as rep_key
 import keyboards.inline_keyboards as inl_key
 from utils.initialization import bot, dp
 import utils.helpers as helpers
+from database.users import UserInfo
+from utils.middlewares import DatabaseDebugMiddleware, UserContextMiddleware
 import texts as text
-from database.models import User
 
 
 class EditConcertStates(StatesGroup):
@@ -68,15 +70,16 @@ class StatisticsStates(StatesGroup):
     waiting_for_statistics_type = State()
 
 
-@dp.message(Command('start'))
-async def start(message: types.Message):
-    user = await database.get_or_create_user(message.from_user.id,
-                                             message.from_user.username,
-                                             message.from_user.full_name,)
-    is_subscribed = await helpers.check_channel_subscription(message.from_user.id)
+if config.DATABASE_DEBUG:
+    dp.update.outer_middleware(DatabaseDebugMiddleware(database))
+
+user_context = UserContextMiddleware(database, helpers.check_channel_subscription)
+dp.message.outer_middleware(user_context)
+dp.callback_query.outer_middleware(user_context)
 
-    await database.update_user_subscription(message.from_user.id, is_subscribed)
 
+@dp.message(Command('start'))
+async def start(message: types.Message, user: UserInfo, is_subscribed: bool):
     if is_subscribed:
         keyboard = await rep_key.get_role_based_keyboard(user.role)
         await message.answer(text.subscribed_1, reply_markup=keyboard)
@@ -133,16 +136,7 @@ async def back_from_description(message: types.Message, state: FSMContext):
 
 
 @dp.message(F.text == '🔄 Отправить голосвание (по группам)')
-async def show_voting_menu(message: types.Message):
-    user = await database.get_or_create_user(
-        telegram_id=message.from_user.id,
-        username=message.from_user.username,
-        full_name=message.from_user.full_name
-    )
-
-    is_subscribed = await helpers.check_channel_subscription(message.from_user.id)
-
-    await database.update_user_subscription(message.from_user.id, is_subscribed)
+async def show_voting_menu(message: types.Message, user: UserInfo, is_subscribed: bool):
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         return await message.answer(text.not_subscribed_1, reply_markup=keyboard)
@@ -153,9 +147,7 @@ async def show_voting_menu(message: types.Message):
 
     await message.answer('⏳ Начинаю рассылку...')
     await asyncio.sleep(4)
-    session = database._get_session()
-    users = session.query(User).filter(
-        User.subscribed == True, User.role.in_(['member', 'user'])).all()
+    users = await database.get_all_subscribed_users()
     total_users = len(users)
     sent_count = 0
     already_voted_count = 0
@@ -385,7 +377,8 @@ async def process_photos(message: types.Message, state: FSMContext):
             await message.answer('❌ Достигнут лимит в 10 фото!')
             return
 
-        photos.append(message.photo[-1].file_id)
+        photos.append({'file_id': message.photo[-1].file_id,
+                       'file_unique_id': message.photo[-1].file_unique_id})
         await state.update_data(photos=photos)
 
         keyboard = await rep_key.get_photos_keyboard()
@@ -405,20 +398,19 @@ async def check_subscription(callback: types.CallbackQuery):
 
     await asyncio.sleep(2)
 
-    is_subscribed = await helpers.check_channel_subscription(user_id)
-    await database.update_user_subscription(user_id, is_subscribed)
+    # Пользователь только что подписался -- кэш и сохраненное состояние не годятся
+    is_subscribed = await helpers.check_channel_subscription(user_id, force=True)
+    # Проверка могла уже обновить подписку, поэтому пользователь берется заново
+    user = await database.get_user_info(
+        user_id, callback.from_user.username, callback.from_user.full_name)
+    if is_subscribed != user.subscribed:
+        await database.update_user_subscription(user_id, is_subscribed)
 
     if is_subscribed:
-        user = await database.get_or_create_user(
-            telegram_id=user_id,
-            username=callback.from_user.username,
-            full_name=callback.from_user.full_name
-        )
-
-        has_voted = await database.has_user_voted(user_id)
+        has_voted = await database.has_user_voted(user.id)
 
         if not has_voted:
-            keyboard = await inl_key.all_groups_keyboard()
+            keyboard = await inl_key.all_groups_keyboard(database.groups)
             return await callback.message.edit_text(
                 text.after_subscribed_1,
                 reply_markup=keyboard
@@ -430,6 +422,11 @@ async def check_subscription(callback: types.CallbackQuery):
         return await callback.message.answer(text.not_subscribed_1, reply_markup=keyboard)
 
 
+@dp.chat_member()
+async def channel_member_updated(event: types.ChatMemberUpdated):
+    await helpers.on_channel_member_updated(event)
+
+
 @dp.callback_query(F.data == 'no_each_one')
 async def no_each_one(callback: types.CallbackQuery):
     await callback.message.delete()
@@ -440,19 +437,9 @@ async def no_each_one(callback: types.CallbackQuery):
 
 
 @dp.callback_query(F.data.startswith('group_'))
-async def get_group_clicked(callback: types.CallbackQuery):
+async def get_group_clicked(callback: types.CallbackQuery, user: UserInfo, is_subscribed: bool):
     group_id = int(callback.data.split('_')[1])
-    user_id = callback.from_user.id
 
-    user = await database.get_or_create_user(
-        telegram_id=user_id,
-        username=callback.from_user.username,
-        full_name=callback.from_user.full_name
-    )
-
-    is_subscribed = await helpers.check_channel_subscription(callback.from_user.id)
-
-    await database.update_user_subscription(callback.from_user.id, is_subscribed)
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         return await callback.message.answer(text.not_subscribed_1, reply_markup=keyboard)
@@ -469,14 +456,7 @@ async def get_group_clicked(callback: types.CallbackQuery):
 
 
 @dp.message(F.text == '💰 Розыгрыш среди групп')
-async def show_voting_results(message: types.Message):
-    user = await database.get_or_create_user(
-        telegram_id=message.from_user.id,
-        username=message.from_user.username,
-        full_name=message.from_user.full_name
-    )
-
-    is_subscribed = await helpers.check_channel_subscription(user.telegram_id)
+async def show_voting_results(message: types.Message, user: UserInfo, is_subscribed: bool):
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         await message.answer(
@@ -488,12 +468,12 @@ async def show_voting_results(message: types.Message):
     if user.role not in ('admin', 'leading'):
         return await message.answer('❌ У вас нет доступа к этой команде')
 
-    groups = await database.get_all_groups()
-
-    if not groups:
+    if not database.groups:
         await message.answer('Голосование еще не началось.')
         return
 
+    points = await database.get_group_points()
+
     text = '📊 <b>Результаты голосования:</b>\n\n'
 
     winners = []
@@ -501,8 +481,8 @@ async def show_voting_results(message: types.Message):
 
     # Собираем данные о голосах и находим максимальное количество
     groups_data = []
-    for i, group in enumerate(groups, start=1):
-        votes = int(group.points) if group.points else 0
+    for i, group in enumerate(database.groups, start=1):
+        votes = points.get(group.id, 0)
         groups_data.append({
             'name': group.name,
             'votes': votes,
@@ -532,12 +512,7 @@ async def show_voting_results(message: types.Message):
 
 
 @dp.message(F.text == '🎫 Получить билет')
-async def get_ticket(message: types.Message):
-    user = await database.get_or_create_user(message.from_user.id,
-                                             message.from_user.username,
-                                             message.from_user.full_name,)
-
-    is_subscribed = await helpers.check_channel_subscription(user.telegram_id)
+async def get_ticket(message: types.Message, user: UserInfo, is_subscribed: bool):
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         await message.answer(
@@ -556,17 +531,8 @@ async def get_ticket(message: types.Message):
 
 
 @dp.callback_query(F.data.startswith('concert_'))
-async def select_concert(callback: types.CallbackQuery):
+async def select_concert(callback: types.CallbackQuery, user: UserInfo, is_subscribed: bool):
     concert_id = int(callback.data.split('_')[1])
-    user = await database.get_or_create_user(
-        callback.from_user.id,
-        callback.from_user.username,
-        callback.from_user.full_name
-    )
-
-    is_subscribed = await helpers.check_channel_subscription(callback.from_user.id)
-
-    await database.update_user_subscription(callback.from_user.id, is_subscribed)
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         return await callback.message.answer(text.not_subscribed_1, reply_markup=keyboard)
@@ -582,15 +548,7 @@ async def select_concert(callback: types.CallbackQuery):
 
 
 @dp.message(F.text == '📋 Мои билеты')
-async def my_tickets(message: types.Message):
-    user = await database.get_or_create_user(
-        message.from_user.id,
-        message.from_user.username,
-        message.from_user.full_name,
-    )
-    is_subscribed = await helpers.check_channel_subscription(message.from_user.id)
-
-    await database.update_user_subscription(message.from_user.id, is_subscribed)
+async def my_tickets(message: types.Message, user: UserInfo, is_subscribed: bool):
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         return await message.answer(text.not_subscribed_1, reply_markup=keyboard)
@@ -605,16 +563,9 @@ async def my_tickets(message: types.Message):
 
 
 @dp.callback_query(F.data.startswith('ticket_concert_'))
-async def select_ticket_concert(callback: types.CallbackQuery):
+async def select_ticket_concert(callback: types.CallbackQuery,
+                                user: UserInfo, is_subscribed: bool):
     concert_id = int(callback.data.split('_')[2])
-    user = await database.get_or_create_user(
-        callback.from_user.id,
-        callback.from_user.username,
-        callback.from_user.full_name,
-    )
-    is_subscribed = await helpers.check_channel_subscription(callback.from_user.id)
-
-    await database.update_user_subscription(callback.from_user.id, is_subscribed)
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         return await callback.message.answer(text.not_subscribed_1, reply_markup=keyboard)
@@ -656,6 +607,38 @@ async def admin(message: types.Message):
     await message.answer('👨‍💻 Панель администратора', reply_markup=keyboard)
 
 
+@dp.message(Command('reload_groups'))
+async def reload_groups(message: types.Message):
+    if message.from_user.id not in config.ADMIN_IDS:
+        return await message.answer('❌ У вас нет доступа к этой команде.')
+
+    count = await database.reload_groups()
+    await message.answer(f'🔄 Список групп обновлен: {count} шт.')
+
+
+@dp.message(Command('cache_stats'))
+async def cache_stats(message: types.Message):
+    if message.from_user.id not in config.ADMIN_IDS:
+        return await message.answer('❌ У вас нет доступа к этой команде.')
+
+    stats = helpers.subscription_cache.stats()
+    user_stats = database.users.stats()
+    await message.answer(
+        '🗄 <b>Кэш проверок подписки</b>\n\n'
+        f'Записей: {stats["size"]}\n'
+        f'Попаданий: {stats["hits"]}\n'
+        f'Промахов: {stats["misses"]}\n'
+        f'Доля попаданий: {stats["hit_rate"]:.1f}%\n\n'
+        '👤 <b>Кэш пользователей</b>\n\n'
+        f'Записей: {user_stats["size"]} из {database.users.max_size}\n'
+        f'Попаданий: {user_stats["hits"]}\n'
+        f'Промахов: {user_stats["misses"]}\n'
+        f'Доля попаданий: {user_stats["hit_rate"]:.1f}%\n'
+        f'Изменений в очереди на запись: {len(database.user_updates)}',
+        parse_mode='HTML'
+    )
+
+
 @dp.message(F.text == '📋 Управление концертами')
 async def manage_concerts(message: types.Message):
     if message.from_user.id not in config.ADMIN_IDS:
@@ -1200,9 +1183,9 @@ async def process_new_photos(message: types.Message, state: FSMContext):
         return
 
     largest_photo = message.photo[-1]
-    photo_id = largest_photo.file_id
 
-    current_photos.append(photo_id)
+    current_photos.append({'file_id': largest_photo.file_id,
+                           'file_unique_id': largest_photo.file_unique_id})
     await state.update_data(photos=current_photos)
 
     concert = await database.get_concert_by_id(concert_id)
@@ -1297,16 +1280,9 @@ async def appoint_leading_start(message: types.Message, state: FSMContext):
 
 
 @dp.message(AppointLeadingStates.searching_user, F.text == '❌ Отмена')
-async def cancel_searching_user(message: types.Message, state: FSMContext):
+async def cancel_searching_user(message: types.Message, state: FSMContext,
+                                user: UserInfo, is_subscribed: bool):
     await state.clear()
-    user = await database.get_or_create_user(
-        message.from_user.id,
-        message.from_user.username,
-        message.from_user.full_name,
-    )
-    is_subscribed = await helpers.check_channel_subscription(message.from_user.id)
-
-    await database.update_user_subscription(message.from_user.id, is_subscribed)
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         return await message.answer(text.not_subscribed_1, reply_markup=keyboard)
@@ -1434,17 +1410,9 @@ async def select_another_user(message: types.Message, state: FSMContext):
 
 
 @dp.message(AppointLeadingStates.confirming_user, F.text == '❌ Отмена')
-async def cancel_in_confirming_user(message: types.Message, state: FSMContext):
+async def cancel_in_confirming_user(message: types.Message, state: FSMContext,
+                                    user: UserInfo, is_subscribed: bool):
     await state.clear()
-    user = await database.get_or_create_user(
-        message.from_user.id,
-        message.from_user.username,
-        message.from_user.full_name,
-    )
-
-    is_subscribed = await helpers.check_channel_subscription(message.from_user.id)
-
-    await database.update_user_subscription(message.from_user.id, is_subscribed)
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         return await message.answer(text.not_subscribed_1, reply_markup=keyboard)
@@ -1551,17 +1519,9 @@ async def appoint_checker_start(message: types.Message, state: FSMContext):
 
 
 @dp.message(AppointCheckerStates.searching_user, F.text == '❌ Отмена')
-async def cancel_checker_search(message: types.Message, state: FSMContext):
+async def cancel_checker_search(message: types.Message, state: FSMContext,
+                                user: UserInfo, is_subscribed: bool):
     await state.clear()
-    user = await database.get_or_create_user(
-        message.from_user.id,
-        message.from_user.username,
-        message.from_user.full_name,
-    )
-
-    is_subscribed = await helpers.check_channel_subscription(message.from_user.id)
-
-    await database.update_user_subscription(message.from_user.id, is_subscribed)
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         return await message.answer(text.not_subscribed_1, reply_markup=keyboard)
@@ -1654,17 +1614,9 @@ async def select_another_user_checker(message: types.Message, state: FSMContext)
 
 
 @dp.message(AppointCheckerStates.confirming_user, F.text == '❌ Отмена')
-async def cancel_checker_in_confirming(message: types.Message, state: FSMContext):
+async def cancel_checker_in_confirming(message: types.Message, state: FSMContext,
+                                       user: UserInfo, is_subscribed: bool):
     await state.clear()
-    user = await database.get_or_create_user(
-        message.from_user.id,
-        message.from_user.username,
-        message.from_user.full_name,
-    )
-
-    is_subscribed = await helpers.check_channel_subscription(message.from_user.id)
-
-    await database.update_user_subscription(message.from_user.id, is_subscribed)
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         return await message.answer(text.not_subscribed_1, reply_markup=keyboard)
@@ -1739,17 +1691,9 @@ async def remove_leading_start(message: types.Message, state: FSMContext):
 
 
 @dp.message(RemoveLeadingStates.searching_user, F.text == '❌ Отмена')
-async def cancel_remove_leading_search(message: types.Message, state: FSMContext):
+async def cancel_remove_leading_search(message: types.Message, state: FSMContext,
+                                       user: UserInfo, is_subscribed: bool):
     await state.clear()
-    user = await database.get_or_create_user(
-        message.from_user.id,
-        message.from_user.username,
-        message.from_user.full_name,
-    )
-
-    is_subscribed = await helpers.check_channel_subscription(message.from_user.id)
-
-    await database.update_user_subscription(message.from_user.id, is_subscribed)
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         return await message.answer(text.not_subscribed_1, reply_markup=keyboard)
@@ -1765,7 +1709,7 @@ async def search_user_remove_leading(message: types.Message, state: FSMContext):
         await message.answer('❌ Пожалуйста, введите поисковый запрос.')
         return
 
-    found_users = await database.search_users(search_query)
+    found_users = await database.search_users(search_query, role='leading')
 
     if not found_users:
         await message.answer(
@@ -1849,17 +1793,9 @@ async def select_another_user_remove_leading(message: types.Message, state: FSMC
 
 
 @dp.message(RemoveLeadingStates.confirming_user, F.text == '❌ Отмена')
-async def cancel_remove_leading_in_confirming(message: types.Message, state: FSMContext):
+async def cancel_remove_leading_in_confirming(message: types.Message, state: FSMContext,
+                                              user: UserInfo, is_subscribed: bool):
     await state.clear()
-    user = await database.get_or_create_user(
-        message.from_user.id,
-        message.from_user.username,
-        message.from_user.full_name,
-    )
-
-    is_subscribed = await helpers.check_channel_subscription(message.from_user.id)
-
-    await database.update_user_subscription(message.from_user.id, is_subscribed)
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         return await message.answer(text.not_subscribed_1, reply_markup=keyboard)
@@ -1928,17 +1864,9 @@ async def remove_checker_start(message: types.Message, state: FSMContext):
 
 
 @dp.message(RemoveCheckerStates.searching_user, F.text == '❌ Отмена')
-async def cancel_remove_checker_search(message: types.Message, state: FSMContext):
+async def cancel_remove_checker_search(message: types.Message, state: FSMContext,
+                                       user: UserInfo, is_subscribed: bool):
     await state.clear()
-    user = await database.get_or_create_user(
-        message.from_user.id,
-        message.from_user.username,
-        message.from_user.full_name,
-    )
-
-    is_subscribed = await helpers.check_channel_subscription(message.from_user.id)
-
-    await database.update_user_subscription(message.from_user.id, is_subscribed)
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         return await message.answer(text.not_subscribed_1, reply_markup=keyboard)
@@ -1954,7 +1882,7 @@ async def search_user_remove_checker(message: types.Message, state: FSMContext):
         await message.answer('❌ Пожалуйста, введите поисковый запрос.')
         return
 
-    found_users = await database.search_users(search_query)
+    found_users = await database.search_users(search_query, role='checker')
 
     if not found_users:
         await message.answer(
@@ -2038,17 +1966,9 @@ async def select_another_user_remove_checker(message: types.Message, state: FSMC
 
 
 @dp.message(RemoveCheckerStates.confirming_user, F.text == '❌ Отмена')
-async def cancel_remove_checker_in_confirming(message: types.Message, state: FSMContext):
+async def cancel_remove_checker_in_confirming(message: types.Message, state: FSMContext,
+                                              user: UserInfo, is_subscribed: bool):
     await state.clear()
-    user = await database.get_or_create_user(
-        message.from_user.id,
-        message.from_user.username,
-        message.from_user.full_name,
-    )
-
-    is_subscribed = await helpers.check_channel_subscription(message.from_user.id)
-
-    await database.update_user_subscription(message.from_user.id, is_subscribed)
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         return await message.answer(text.not_subscribed_1, reply_markup=keyboard)
@@ -2109,83 +2029,66 @@ async def show_users_by_role(message: types.Message):
     )
 
 
-@dp.message(F.text == '👑 Ведущие')
-async def show_leading_users(message: types.Message):
-    leading_users = await database.get_users_by_role('leading')
-
-    if not leading_users:
-        await message.answer('📭 Нет пользователей с ролью "ведущий".')
-        return
-
-    text = '👑 <b>Список ведущих:</b>\n\n'
-    for i, user in enumerate(leading_users, 1):
-        text += f'{i}. <b>{user["full_name"]}</b>\n'
-        if user['username']:
-            text += f'   @{user["username"]}\n'
-        text += f'   🆔 ID: {user["telegram_id"]}\n'
-        text += f'   📅 Создан: {user["created_at"].strftime("%d.%m.%Y")}\n\n'
-
-    await message.answer(text, parse_mode='HTML')
+ROLE_LISTS = {
+    'leading': ('👑 <b>Список ведущих:</b>', '📭 Нет пользователей с ролью "ведущий".'),
+    'checker': ('🎫 <b>Список проверяющих:</b>', '📭 Нет пользователей с ролью "проверяющий".'),
+    'user': ('👥 <b>Список обычных пользователей:</b>',
+             '📭 Нет пользователей с ролью "обычный пользователь".'),
+    'admin': ('👨‍💻 <b>Список администраторов:</b>', '📭 Нет пользователей с ролью "администратор".'),
+}
 
 
-@dp.message(F.text == '🎫 Проверяющие')
-async def show_checker_users(message: types.Message):
-    checker_users = await database.get_users_by_role('checker')
+async def role_list_page(role, cursor=None, direction='next'):
+    title, empty_text = ROLE_LISTS[role]
+    page = await database.get_users_by_role(role, cursor, direction)
 
-    if not checker_users:
-        await message.answer('📭 Нет пользователей с ролью "проверяющий".')
-        return
+    if not page['users']:
+        return empty_text, None
 
-    text = '🎫 <b>Список проверяющих:</b>\n\n'
-    for i, user in enumerate(checker_users, 1):
-        text += f'{i}. <b>{user["full_name"]}</b>\n'
+    text = f'{title}\n\n'
+    for user in page['users']:
+        text += f'• <b>{user["full_name"]}</b>\n'
         if user['username']:
             text += f'   @{user["username"]}\n'
         text += f'   🆔 ID: {user["telegram_id"]}\n'
         text += f'   📅 Создан: {user["created_at"].strftime("%d.%m.%Y")}\n\n'
 
-    await message.answer(text, parse_mode='HTML')
+    keyboard = await inl_key.role_list_pagination_keyboard(
+        role, page['prev_cursor'], page['next_cursor'])
+    return text, keyboard
 
 
-@dp.message(F.text == '👥 Обычные пользователи')
-async def show_regular_users(message: types.Message):
-    regular_users = await database.get_users_by_role('user')
+@dp.message(F.text == '👑 Ведущие')
+async def show_leading_users(message: types.Message):
+    text, keyboard = await role_list_page('leading')
+    await message.answer(text, parse_mode='HTML', reply_markup=keyboard)
 
-    if not regular_users:
-        await message.answer('📭 Нет пользователей с ролью "обычный пользователь".')
-        return
 
-    text = '👥 <b>Список обычных пользователей:</b>\n\n'
-    for i, user in enumerate(regular_users[:20], 1):
-        text += f'{i}. <b>{user["full_name"]}</b>\n'
-        if user['username']:
-            text += f'   @{user["username"]}\n'
-        text += f'   🆔 ID: {user["telegram_id"]}\n'
-        text += f'   📅 Создан: {user["created_at"].strftime("%d.%m.%Y")}\n\n'
+@dp.message(F.text == '🎫 Проверяющие')
+async def show_checker_users(message: types.Message):
+    text, keyboard = await role_list_page('checker')
+    await message.answer(text, parse_mode='HTML', reply_markup=keyboard)
 
-    if len(regular_users) > 20:
-        text += f'\n📊 И еще {len(regular_users) - 20} пользователей...'
 
-    await message.answer(text, parse_mode='HTML')
+@dp.message(F.text == '👥 Обычные пользователи')
+async def show_regular_users(message: types.Message):
+    text, keyboard = await role_list_page('user')
+    await message.answer(text, parse_mode='HTML', reply_markup=keyboard)
 
 
 @dp.message(F.text == '👨‍💻 Администраторы')
 async def show_admin_users(message: types.Message):
-    admin_users = await database.get_users_by_role('admin')
+    text, keyboard = await role_list_page('admin')
+    await message.answer(text, parse_mode='HTML', reply_markup=keyboard)
 
-    if not admin_users:
-        await message.answer('📭 Нет пользователей с ролью "администратор".')
-        return
 
-    text = '👨‍💻 <b>Список администраторов:</b>\n\n'
-    for i, user in enumerate(admin_users, 1):
-        text += f'{i}. <b>{user["full_name"]}</b>\n'
-        if user['username']:
-            text += f'   @{user["username"]}\n'
-        text += f'   🆔 ID: {user["telegram_id"]}\n'
-        text += f'   📅 Создан: {user["created_at"].strftime("%d.%m.%Y")}\n\n'
+@dp.callback_query(F.data.startswith('role_page_'))
+async def show_role_list_page(callback: types.CallbackQuery):
+    role, direction, cursor = callback.data[len('role_page_'):].split('_', 2)
 
-    await message.answer(text, parse_mode='HTML')
+    text, keyboard = await role_list_page(role, cursor, direction)
+    await callback.message.edit_text(text, parse_mode='HTML', reply_markup=keyboard)
+    await callback.answer()
 
 
 @dp.callback_query(F.data == 'cancel_selection')
@@ -2196,14 +2099,8 @@ async def cancel_user_selection(callback: types.CallbackQuery, state: FSMContext
 
 
 @dp.message(F.text == '🎫 Проверить билет')
-async def check_ticket_start(message: types.Message, state: FSMContext):
-    user = await database.get_or_create_user(message.from_user.id,
-                                             message.from_user.username,
-                                             message.from_user.full_name,)
-
-    is_subscribed = await helpers.check_channel_subscription(message.from_user.id)
-
-    await database.update_user_subscription(message.from_user.id, is_subscribed)
+async def check_ticket_start(message: types.Message, state: FSMContext,
+                             user: UserInfo, is_subscribed: bool):
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         return await message.answer(text.not_subscribed_1, reply_markup=keyboard)
@@ -2221,14 +2118,8 @@ async def check_ticket_start(message: types.Message, state: FSMContext):
 
 
 @dp.message(F.text == '🎫 Проверить по коду')
-async def check_ticket_by_code(message: types.Message, state: FSMContext):
-    user = await database.get_or_create_user(message.from_user.id,
-                                             message.from_user.username,
-                                             message.from_user.full_name,)
-
-    is_subscribed = await helpers.check_channel_subscription(message.from_user.id)
-
-    await database.update_user_subscription(message.from_user.id, is_subscribed)
+async def check_ticket_by_code(message: types.Message, state: FSMContext,
+                               user: UserInfo, is_subscribed: bool):
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         return await message.answer(text.not_subscribed_1, reply_markup=keyboard)
@@ -2247,15 +2138,9 @@ async def check_ticket_by_code(message: types.Message, state: FSMContext):
 
 
 @dp.message(CheckTicketStates.waiting_for_ticket_code, F.text == '❌ Отмена')
-async def cancel_ticket_check(message: types.Message, state: FSMContext):
+async def cancel_ticket_check(message: types.Message, state: FSMContext,
+                              user: UserInfo, is_subscribed: bool):
     await state.clear()
-    user = await database.get_or_create_user(message.from_user.id,
-                                             message.from_user.username,
-                                             message.from_user.full_name,)
-
-    is_subscribed = await helpers.check_channel_subscription(message.from_user.id)
-
-    await database.update_user_subscription(message.from_user.id, is_subscribed)
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         return await message.answer(text.not_subscribed_1, reply_markup=keyboard)
@@ -2265,9 +2150,9 @@ async def cancel_ticket_check(message: types.Message, state: FSMContext):
 
 @dp.message(CheckTicketStates.waiting_for_ticket_code)
 async def process_ticket_code(message: types.Message, state: FSMContext):
-    ticket_code = message.text.strip().upper()
+    ticket_code = message.text.strip()
 
-    if len(ticket_code) != 8:
+    if len(normalize_code(ticket_code)) != 8:
         await message.answer('❌ Код билета должен состоять из 8 символов.')
         return
 
@@ -2305,27 +2190,20 @@ async def process_ticket_code(message: types.Message, state: FSMContext):
 async def use_ticket(callback: types.CallbackQuery):
     ticket_id = int(callback.data.split('_')[2])
 
-    success = await database.mark_ticket_as_used(ticket_id)
+    success, result = await database.mark_ticket_as_used(ticket_id, callback.from_user.id)
 
     if success:
-        await callback.answer('✅ Билет отмечен как использованный!', show_alert=True)
+        await callback.answer(result, show_alert=True)
         await callback.message.edit_text(
             callback.message.text + '\n\n✅ Билет использован',
             parse_mode='HTML'
         )
     else:
-        await callback.answer('❌ Ошибка при отметке билета', show_alert=True)
+        await callback.answer(result, show_alert=True)
 
 
 @dp.message(F.text == '📊 Статистика')
-async def statistics_start(message: types.Message):
-    user = await database.get_or_create_user(message.from_user.id,
-                                             message.from_user.username,
-                                             message.from_user.full_name,)
-
-    is_subscribed = await helpers.check_channel_subscription(message.from_user.id)
-
-    await database.update_user_subscription(message.from_user.id, is_subscribed)
+async def statistics_start(message: types.Message, user: UserInfo, is_subscribed: bool):
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         return await message.answer(text.not_subscribed_1, reply_markup=keyboard)
@@ -2343,14 +2221,7 @@ async def statistics_start(message: types.Message):
 
 
 @dp.message(F.text == '📊 Статистика по концертам')
-async def concerts_statistics(message: types.Message):
-    user = await database.get_or_create_user(message.from_user.id,
-                                             message.from_user.username,
-                                             message.from_user.full_name,)
-
-    is_subscribed = await helpers.check_channel_subscription(message.from_user.id)
-
-    await database.update_user_subscription(message.from_user.id, is_subscribed)
+async def concerts_statistics(message: types.Message, user: UserInfo, is_subscribed: bool):
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         return await message.answer(text.not_subscribed_1, reply_markup=keyboard)
@@ -2382,14 +2253,7 @@ async def concerts_statistics(message: types.Message):
 
 
 @dp.message(F.text == '👥 Статистика по пользователям')
-async def users_statistics(message: types.Message):
-    user = await database.get_or_create_user(message.from_user.id,
-                                             message.from_user.username,
-                                             message.from_user.full_name,)
-
-    is_subscribed = await helpers.check_channel_subscription(message.from_user.id)
-
-    await database.update_user_subscription(message.from_user.id, is_subscribed)
+async def users_statistics(message: types.Message, user: UserInfo, is_subscribed: bool):
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         return await message.answer(text.not_subscribed_1, reply_markup=keyboard)
@@ -2420,14 +2284,7 @@ async def users_statistics(message: types.Message):
 
 
 @dp.message(F.text == '🎫 Статистика по билетам')
-async def tickets_statistics(message: types.Message):
-    user = await database.get_or_create_user(message.from_user.id,
-                                             message.from_user.username,
-                                             message.from_user.full_name,)
-
-    is_subscribed = await helpers.check_channel_subscription(message.from_user.id)
-
-    await database.update_user_subscription(message.from_user.id, is_subscribed)
+async def tickets_statistics(message: types.Message, user: UserInfo, is_subscribed: bool):
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         return await message.answer(text.not_subscribed_1, reply_markup=keyboard)
@@ -2453,14 +2310,7 @@ async def tickets_statistics(message: types.Message):
 
 
 @dp.message(F.text == '🔙 Назад')
-async def back_to_previous(message: types.Message):
-    user = await database.get_or_create_user(message.from_user.id,
-                                             message.from_user.username,
-                                             message.from_user.full_name,)
-
-    is_subscribed = await helpers.check_channel_subscription(message.from_user.id)
-
-    await database.update_user_subscription(message.from_user.id, is_subscribed)
+async def back_to_previous(message: types.Message, user: UserInfo, is_subscribed: bool):
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         return await message.answer(text.not_subscribed_1, reply_markup=keyboard)
@@ -2469,14 +2319,7 @@ async def back_to_previous(message: types.Message):
 
 
 @dp.message(F.text == '🎲 Розыгрыш среди зала')
-async def choose_human_from_hall(message: types.Message):
-    user = await database.get_or_create_user(message.from_user.id,
-                                             message.from_user.username,
-                                             message.from_user.full_name,)
-
-    is_subscribed = await helpers.check_channel_subscription(message.from_user.id)
-
-    await database.update_user_subscription(message.from_user.id, is_subscribed)
+async def choose_human_from_hall(message: types.Message, user: UserInfo, is_subscribed: bool):
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         return await message.answer(text.not_subscribed_1, reply_markup=keyboard)
@@ -2497,22 +2340,20 @@ async def choose_human_from_hall(message: types.Message):
 
 
 @dp.message()
-async def handle_all(message: types.Message):
-    user = await database.get_or_create_user(message.from_user.id,
-                                             message.from_user.username,
-                                             message.from_user.full_name,)
-
-    is_subscribed = await helpers.check_channel_subscription(message.from_user.id)
-
-    await database.update_user_subscription(message.from_user.id, is_subscribed)
+async def handle_all(message: types.Message, user: UserInfo, is_subscribed: bool):
     if not is_subscribed:
         keyboard = await inl_key.get_subscription_keyboard_with_link(config.CHANNEL_USERNAMES)
         return await message.answer(text.not_subscribed_1, reply_markup=keyboard)
 
 
 async def main():
+    dp.startup.register(database.startup)
+    dp.startup.register(helpers.start_subscription_sweeps)
+    dp.shutdown.register(helpers.stop_subscription_sweeps)
+    dp.shutdown.register(database.shutdown)
     print('🤖 Бот запущен...')
-    await dp.start_polling(bot)
+    # chat_member Telegram присылает, только если запросить его явно
+    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
 
 
 if __name__ == '__main__':
@@ -8,6 +8,41 @@ class Config:
     BOT_TOKEN = os.environ.get('BOT_TOKEN')
     CHANNEL_USERNAMES = os.environ.get('CHANNEL_USERNAMES').replace(' ', '').split(',')
     DATABASE_URL = os.environ.get('DATABASE_URL')
+    # Реплика только для чтения: статистика, поиск, списки и рассылки
+    DATABASE_READ_URL = os.environ.get('DATABASE_READ_URL')
+    # async -- нативный AsyncSession, threadpool -- синхронная Session в пуле потоков
+    DATABASE_EXECUTION_MODE = os.environ.get('DATABASE_EXECUTION_MODE', 'async')
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 5))
+    DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW', 10))
+    DATABASE_SLOW_QUERY_MS = float(os.environ.get('DATABASE_SLOW_QUERY_MS', 200))
+    # Профиль SQLite: WAL, busy_timeout, mmap и одна очередь для записей
+    SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+    SQLITE_SINGLE_WRITER = os.environ.get('SQLITE_SINGLE_WRITER', '1').lower() in ('1', 'true', 'yes')
+    DATABASE_DEBUG = os.environ.get('DATABASE_DEBUG', '').lower() in ('1', 'true', 'yes')
+    TICKET_CODE_POOL_SIZE = int(os.environ.get('TICKET_CODE_POOL_SIZE', 500))
+    TICKET_CODE_POOL_LOW_WATERMARK = int(os.environ.get('TICKET_CODE_POOL_LOW_WATERMARK', 100))
+    # Клавиатура выбора пользователя все равно показывает не больше 10 кнопок
+    SEARCH_RESULTS_LIMIT = int(os.environ.get('SEARCH_RESULTS_LIMIT', 10))
+    # Страница списка по ролям должна уложиться в лимит сообщения Telegram (4096 символов)
+    ROLE_LIST_PAGE_SIZE = int(os.environ.get('ROLE_LIST_PAGE_SIZE', 10))
+    # Кэш проверок подписки: подписанных проверяем редко, неподписанных -- часто,
+    # чтобы после подписки бот быстро это заметил
+    SUBSCRIPTION_CACHE_TTL = float(os.environ.get('SUBSCRIPTION_CACHE_TTL', 300))
+    SUBSCRIPTION_CACHE_NEGATIVE_TTL = float(os.environ.get('SUBSCRIPTION_CACHE_NEGATIVE_TTL', 15))
+    SUBSCRIPTION_CACHE_SIZE = int(os.environ.get('SUBSCRIPTION_CACHE_SIZE', 10000))
+    # Сколько последних пользователей (id, роль, подписка) держать в памяти
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 10000))
+    # Изменения подписки и профиля копятся в памяти и пишутся пачкой раз в столько секунд
+    USER_UPDATES_FLUSH_INTERVAL = float(os.environ.get('USER_UPDATES_FLUSH_INTERVAL', 5))
+    # Проверка подписки: таймаут на один канал и ответ, если Telegram не смог ответить
+    # (fail-open -- пускаем, fail-closed -- считаем неподписанным)
+    SUBSCRIPTION_CHECK_TIMEOUT = float(os.environ.get('SUBSCRIPTION_CHECK_TIMEOUT', 3))
+    SUBSCRIPTION_FAIL_OPEN = os.environ.get('SUBSCRIPTION_FAIL_OPEN', '').lower() in ('1', 'true', 'yes')
+    # Сверка локального состояния подписок с Bot API (на случай пропущенных
+    # событий chat_member): раз в интервал, с паузой между пользователями. 0 -- выключена
+    SUBSCRIPTION_RECONCILE_INTERVAL = float(os.environ.get('SUBSCRIPTION_RECONCILE_INTERVAL', 6 * 60 * 60))
+    SUBSCRIPTION_RECONCILE_DELAY = float(os.environ.get('SUBSCRIPTION_RECONCILE_DELAY', 0.1))
     ADMIN_IDS = list(map(int, os.environ.get('ADMIN_IDS').replace(' ', '').split(',')))
     groups = ['Смысловая нагрузка', 'Реинкарнация',
               'Послезавтра', 'Only minus one',
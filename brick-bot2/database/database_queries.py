@@ -1,15 +1,28 @@
+import contextlib
+import contextvars
 import datetime
-import json
-import string
-import random
+import functools
+import re
+import time
 
 import sqlalchemy
-import sqlalchemy.orm
+import sqlalchemy.dialects.postgresql
+import sqlalchemy.dialects.sqlite
+import sqlalchemy.event
 import sqlalchemy.exc
+import sqlalchemy.ext.asyncio
+import sqlalchemy.orm
 from aiogram.types import InputMediaPhoto
 
 from config import config
-from database.models import Base, User, Concert, Ticket, Group, Vote
+from database import migrations
+from database.groups import GroupRegistry
+from database.models import (User, Concert, ConcertPhoto, Ticket, Group, Vote, StatsCounter,
+                             ChannelSubscription)
+from database.threadpool import ThreadPoolSessionmaker
+from database.ticket_codes import TicketCodePool, normalize_code
+from database.users import UserCache, UserInfo, UserUpdateBuffer
+from database.writer import SerialWriter
 
 RUSSIAN_MONTHS = {
     1: 'января', 2: 'февраля', 3: 'марта', 4: 'апреля',
@@ -23,342 +36,732 @@ RUSSIAN_WEEKDAYS = {
 }
 
 
-class Database:
-    def __init__(self):
-        self.engine = sqlalchemy.create_engine(config.DATABASE_URL)
-        self.Session = sqlalchemy.orm.sessionmaker(bind=self.engine)
-        Base.metadata.create_all(self.engine)
-        self._initialize_default_data()
+TICKET_CODE_ATTEMPTS = 5
 
-    def _initialize_default_data(self):
-        self._ensure_groups_exist()
+# Индекс FTS5 для поиска пользователей в SQLite (см. ревизию 7)
+users_fts = sqlalchemy.table('users_fts', sqlalchemy.column('rowid'), sqlalchemy.column('rank'))
 
-    def _ensure_groups_exist(self):
-        session = self.Session()
+# Учет сессий текущего апдейта, заполняется только в режиме DATABASE_DEBUG
+current_update_scope = contextvars.ContextVar('current_update_scope', default=None)
 
-        groups_list = [
-            'Смысловая нагрузка', 'Реинкарнация', 'Послезавтра',
-            'Only minus one', 'ЭлектропроспектЪ!', 'АСТРАV',
-            'Китовые песни', 'Завтрак чемпиона', 'Степень свободы',
-            'Признаки чувств', 'Строй Аккорд', 'Spring Fever'
-        ]
 
-        try:
-            for group_name in groups_list:
-                group = session.query(Group).filter_by(name=group_name).first()
-                if not group:
-                    group = Group(name=group_name, points=0)
-                    session.add(group)
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'postgres': 'postgresql+asyncpg',
+}
 
-            session.commit()
-        except Exception as e:
-            print(f'Ошибка при создании групп: {e}')
-            session.rollback()
+
+def make_async_url(url):
+    url = sqlalchemy.engine.make_url(url)
+    backend = url.get_backend_name()
+    if backend in ASYNC_DRIVERS:
+        url = url.set(drivername=ASYNC_DRIVERS[backend])
+    return url
+
+
+def is_sqlite_memory(url):
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def engine_options(url):
+    url = sqlalchemy.engine.make_url(url)
+    if is_sqlite_memory(url):
+        return {}
+    return {
+        'pool_size': config.DATABASE_POOL_SIZE,
+        'max_overflow': config.DATABASE_MAX_OVERFLOW,
+    }
+
+
+def apply_sqlite_pragmas(engine, url):
+    # WAL: читатели не ждут писателя; synchronous=NORMAL в WAL безопасен
+    # при падении процесса и не делает fsync на каждый коммит
+    pragmas = [
+        f'PRAGMA busy_timeout = {config.SQLITE_BUSY_TIMEOUT_MS}',
+        f'PRAGMA mmap_size = {config.SQLITE_MMAP_SIZE}',
+    ]
+    if not is_sqlite_memory(url):
+        pragmas[:0] = ['PRAGMA journal_mode = WAL', 'PRAGMA synchronous = NORMAL']
+
+    @sqlalchemy.event.listens_for(getattr(engine, 'sync_engine', engine), 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+
+def serialized_write(method):
+    # Ставится над timed_query: ожидание в очереди писателя -- не время запроса
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        if self.writer is None:
+            return await method(self, *args, **kwargs)
+        return await self.writer.submit(method, self, *args, **kwargs)
+
+    return wrapper
+
+
+def encode_users_cursor(user):
+    return f'{user.created_at:%Y%m%d%H%M%S%f}.{user.id}'
+
+
+def decode_users_cursor(cursor):
+    created_at, user_id = cursor.split('.')
+    return datetime.datetime.strptime(created_at, '%Y%m%d%H%M%S%f'), int(user_id)
+
+
+def timed_query(method):
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await method(self, *args, **kwargs)
         finally:
-            session.close()
+            self.on_query_timing(method.__name__, time.perf_counter() - started)
 
-    def _get_session(self):
-        return self.Session()
+    return wrapper
 
-    def generate_ticket_code(self):
-        return ''.join(random.choices(string.ascii_letters + string.digits, k=8))
 
-    async def get_all_groups(self):
-        session = self._get_session()
-        return session.query(Group).all()
+class Database:
+    def __init__(self, url=None, execution_mode=None, read_url=None):
+        # Движки создаются при первом обращении: импорт модуля ничего не
+        # подключает и не требует DATABASE_URL
+        self.url = url
+        self.read_url = read_url
+        self.execution_mode = execution_mode or config.DATABASE_EXECUTION_MODE
+        self.query_timings = {}
+        self._bound = None
+
+        # Уточняется в startup, когда известно, какие индексы есть в базе
+        self.search_backend = 'like'
+        self.groups = GroupRegistry()
+        self.users = UserCache(config.USER_CACHE_SIZE)
+        self.user_updates = UserUpdateBuffer(self, config.USER_UPDATES_FLUSH_INTERVAL)
+        self.ticket_codes = TicketCodePool(
+            self, config.TICKET_CODE_POOL_SIZE, config.TICKET_CODE_POOL_LOW_WATERMARK)
+
+        self.debug = config.DATABASE_DEBUG
+        self.checked_out = 0
+
+    def _bind(self):
+        if self._bound is not None:
+            return self._bound
+
+        url = self.url or config.DATABASE_URL
+        read_url = self.read_url or config.DATABASE_READ_URL
+
+        engine, Session = self._create_engine(url)
+        # Без реплики чтение идет через основной движок
+        if read_url:
+            read_engine, ReadSession = self._create_engine(read_url)
+        else:
+            read_engine, ReadSession = engine, Session
+
+        # На SQLite записи идут через одну очередь, на серверных СУБД -- напрямую
+        writer = None
+        if engine.dialect.name == 'sqlite' and config.SQLITE_SINGLE_WRITER:
+            writer = SerialWriter()
+
+        self._bound = (engine, Session, read_engine, ReadSession, writer)
+        if self.debug:
+            for engine in self._engines():
+                sync_engine = getattr(engine, 'sync_engine', engine)
+                sqlalchemy.event.listen(sync_engine, 'checkout', self._on_checkout)
+                sqlalchemy.event.listen(sync_engine, 'checkin', self._on_checkin)
+        return self._bound
+
+    @property
+    def engine(self):
+        return self._bind()[0]
+
+    @property
+    def Session(self):
+        return self._bind()[1]
+
+    @property
+    def read_engine(self):
+        return self._bind()[2]
+
+    @property
+    def ReadSession(self):
+        return self._bind()[3]
+
+    @property
+    def writer(self):
+        return self._bind()[4]
+
+    def _create_engine(self, url):
+        if self.execution_mode == 'threadpool':
+            options = engine_options(url)
+            engine = sqlalchemy.create_engine(url, **options)
+            # Потоков столько же, сколько соединений может выдать пул
+            max_workers = options.get('pool_size', 1) + options.get('max_overflow', 0)
+            Session = ThreadPoolSessionmaker(engine, max_workers)
+        elif self.execution_mode == 'async':
+            engine = sqlalchemy.ext.asyncio.create_async_engine(
+                make_async_url(url), **engine_options(url))
+            Session = sqlalchemy.ext.asyncio.async_sessionmaker(
+                bind=engine, expire_on_commit=False)
+        else:
+            raise ValueError(f'Неизвестный режим работы с БД: {self.execution_mode}')
+
+        url = sqlalchemy.engine.make_url(url)
+        if url.get_backend_name() == 'sqlite':
+            apply_sqlite_pragmas(engine, url)
+        return engine, Session
+
+    def _engines(self):
+        if self.read_engine is self.engine:
+            return [self.engine]
+        return [self.engine, self.read_engine]
+
+    def on_query_timing(self, name, elapsed):
+        calls, total = self.query_timings.get(name, (0, 0.0))
+        self.query_timings[name] = (calls + 1, total + elapsed)
+        if elapsed * 1000 >= config.DATABASE_SLOW_QUERY_MS:
+            print(f'Медленный запрос {name}: {elapsed * 1000:.1f} мс')
+
+    async def _run_sync(self, func):
+        if self.execution_mode == 'threadpool':
+            return await self.Session.run_sync(func)
+        async with self.engine.begin() as connection:
+            return await connection.run_sync(func)
+
+    async def startup(self):
+        def bootstrap(connection):
+            # Схема актуальна -- миграции и их проверки не запускаются
+            applied = []
+            if migrations.current_version(connection) != migrations.LATEST_VERSION:
+                applied = migrations.upgrade(connection)
+            return applied, migrations.search_backend(connection)
+
+        applied, self.search_backend = await self._run_sync(bootstrap)
+        if applied:
+            print(f'Применены миграции: {", ".join(map(str, applied))}')
+        await self._ensure_groups_exist()
+        await self.reload_groups()
+        await self.ticket_codes.refill()
+
+    async def migrate(self, target=None):
+        return await self._run_sync(
+            lambda connection: migrations.upgrade(connection, target))
+
+    async def schema_version(self):
+        return await self._run_sync(migrations.current_version)
+
+    async def shutdown(self):
+        await self.ticket_codes.close()
+        self.users.clear()
+        if self._bound is None:
+            return
 
-    async def vote_for_group(self, user_id, group_id):
-        session = self._get_session()
+        try:
+            await self.user_updates.close()
+        except Exception as e:
+            print(f'Изменения пользователей не сохранены при остановке: {e}')
+        if self.writer is not None:
+            await self.writer.close()
+        if self.execution_mode == 'threadpool':
+            for Session in {self.Session, self.ReadSession}:
+                Session.shutdown()
+        else:
+            for engine in self._engines():
+                await engine.dispose()
+        self._bound = None
+
+    async def rebuild_stats_counters(self):
+        def rebuild(connection):
+            connection.execute(StatsCounter.__table__.delete())
+            migrations.fill_stats_counters(
+                connection, StatsCounter.__table__, User.__table__, Ticket.__table__)
+
+        await self._run_sync(rebuild)
+
+    async def _ensure_groups_exist(self):
+        # Одним INSERT: существующие группы пропускаются по уникальному имени
+        async with self.session() as session:
+            try:
+                await session.execute(self._insert(Group).values([
+                    {'name': group_name, 'points': 0, 'position': position}
+                    for position, group_name in enumerate(config.groups, start=1)
+                ]).on_conflict_do_nothing(index_elements=[Group.name]))
+                await session.commit()
+            except Exception as e:
+                print(f'Ошибка при создании групп: {e}')
+                await session.rollback()
+
+    @contextlib.asynccontextmanager
+    async def session(self, read_only=False):
+        session = self.ReadSession() if read_only else self.Session()
+        scope = current_update_scope.get() if self.debug else None
+        if scope is not None:
+            # after_begin срабатывает каждый раз, когда сессия берет соединение из пула
+            def count_connection(sync_session, transaction, connection):
+                scope['connections'] += 1
+
+            scope['sessions'] += 1
+            scope['open'].add(session)
+            sqlalchemy.event.listen(
+                session.sync_session, 'after_begin', count_connection)
 
         try:
-            existing_vote = session.query(Vote).filter_by(
-                user_id=user_id,
-                group_id=group_id
-            ).first()
+            yield session
+        except Exception:
+            await session.rollback()
+            raise
+        finally:
+            await session.close()
+            if scope is not None:
+                scope['open'].discard(session)
 
-            if existing_vote:
-                session.close()
-                return False, '❌ Вы уже голосовали за группу!'
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        self.checked_out += 1
 
-            group = session.query(Group).filter_by(id=group_id).first()
-            if not group:
-                session.close()
-                return False, '❌ Группа не найдена!'
+    def _on_checkin(self, dbapi_connection, connection_record):
+        self.checked_out -= 1
 
-            vote = Vote(user_id=user_id, group_id=group_id)
-            session.add(vote)
+    @contextlib.asynccontextmanager
+    async def update_scope(self, update_id):
+        scope = {'sessions': 0, 'connections': 0, 'open': set()}
+        token = current_update_scope.set(scope)
+        try:
+            yield scope
+        finally:
+            current_update_scope.reset(token)
+            print(f'[db] update {update_id}: сессий {scope["sessions"]}, '
+                  f'соединений {scope["connections"]}, '
+                  f'занято в пуле {self.checked_out}')
+            for session in scope['open']:
+                print(f'[db] update {update_id}: сессия {id(session):#x} '
+                      f'не закрыта после обработчика')
+
+    def _insert(self, entity):
+        if self.engine.dialect.name == 'postgresql':
+            return sqlalchemy.dialects.postgresql.insert(entity)
+        return sqlalchemy.dialects.sqlite.insert(entity)
+
+    async def _bump_counter(self, session, name, key, delta=1):
+        statement = self._insert(StatsCounter).values(name=name, key=str(key), value=delta)
+        await session.execute(statement.on_conflict_do_update(
+            index_elements=[StatsCounter.name, StatsCounter.key],
+            set_={'value': StatsCounter.value + delta},
+        ))
+
+    async def _change_role_counter(self, session, old_role, new_role):
+        if old_role == new_role:
+            return
+        if old_role is not None:
+            await self._bump_counter(session, 'users_by_role', old_role, -1)
+        await self._bump_counter(session, 'users_by_role', new_role)
 
-            group.points += 1
+    def _concert_to_dict(self, concert):
+        return {
+            'id': concert.id,
+            'name': concert.name,
+            'description': concert.description,
+            'date': concert.date,
+            'address': concert.address,
+            'photos': [photo.file_id for photo in concert.photos],
+            'is_active': concert.is_active,
+        }
 
-            session.commit()
-            session.close()
+    def _photo_key(self, file_id, file_unique_id):
+        # У фото, перенесенных из JSON, нет file_unique_id -- сравниваем по file_id
+        return file_unique_id or file_id
 
-            return True, '✅ Ваш голос учтен!'
+    def generate_ticket_code(self):
+        return self.ticket_codes.pop()
 
-        except sqlalchemy.exc.IntegrityError:
-            session.rollback()
-            session.close()
-            return False, '❌ Вы уже голосовали за эту группу!'
-        except Exception as e:
-            session.rollback()
-            session.close()
-            print(f'Ошибка при голосовании: {e}')
-            return False, '❌ Произошла ошибка при голосовании!'
+    @timed_query
+    async def reload_groups(self):
+        async with self.session() as session:
+            groups = (await session.execute(sqlalchemy.select(
+                Group.id, Group.name, Group.position))).all()
+        self.groups.load(groups)
+        return len(self.groups)
 
+    @timed_query
+    async def get_all_groups(self):
+        async with self.session() as session:
+            result = await session.scalars(
+                sqlalchemy.select(Group).order_by(Group.position, Group.id))
+            return result.all()
+
+    @timed_query
+    async def get_group_points(self):
+        async with self.session() as session:
+            rows = (await session.execute(
+                sqlalchemy.select(Group.id, Group.points))).all()
+            return {group_id: points or 0 for group_id, points in rows}
+
+    @serialized_write
+    @timed_query
+    async def vote_for_group(self, user_id, group_id):
+        async with self.session() as session:
+            try:
+                # Существование группы проверяется по реестру, без запроса к БД
+                if group_id not in self.groups:
+                    return False, '❌ Группа не найдена!'
+
+                vote_id = await session.scalar(
+                    self._insert(Vote).values(
+                        user_id=user_id,
+                        group_id=group_id,
+                        created_at=datetime.datetime.now(),
+                    ).on_conflict_do_nothing(
+                        index_elements=[Vote.user_id, Vote.group_id],
+                    ).returning(Vote.id))
+
+                if vote_id is None:
+                    return False, '❌ Вы уже голосовали за группу!'
+
+                # Инкремент на стороне БД, без чтения-изменения-записи в Python
+                await session.execute(sqlalchemy.update(Group).where(
+                    Group.id == group_id,
+                ).values(points=sqlalchemy.func.coalesce(Group.points, 0) + 1))
+
+                await session.commit()
+
+                return True, '✅ Ваш голос учтен!'
+
+            except sqlalchemy.exc.IntegrityError:
+                await session.rollback()
+                return False, '❌ Вы уже голосовали за эту группу!'
+            except Exception as e:
+                await session.rollback()
+                print(f'Ошибка при голосовании: {e}')
+                return False, '❌ Произошла ошибка при голосовании!'
+
+    @timed_query
     async def get_user_votes(self, user_id):
-        session = self._get_session()
-        votes = session.query(Vote).filter_by(user_id=user_id).all()
-
-        result = [vote.group_id for vote in votes]
-        session.close()
-        return result
+        async with self.session() as session:
+            result = await session.scalars(
+                sqlalchemy.select(Vote.group_id).filter_by(user_id=user_id))
+            return result.all()
 
+    @timed_query
     async def has_user_voted(self, user_id, group_id=None):
-        session = self._get_session()
+        query = sqlalchemy.select(Vote.id).filter_by(user_id=user_id)
         if group_id is not None:
-            vote = session.query(Vote).filter_by(
-                user_id=user_id, group_id=group_id).first()
-        else:
-            vote = session.query(Vote).filter_by(user_id=user_id).first()
-        session.close()
-        return vote is not None
+            query = query.filter_by(group_id=group_id)
+
+        async with self.session() as session:
+            vote = await session.scalar(query.limit(1))
+            return vote is not None
 
     async def show_voting_keyboard(self, bot, telegram_id):
         import keyboards.inline_keyboards as inl_key
-        keyboard = await inl_key.all_groups_keyboard()
+        keyboard = await inl_key.all_groups_keyboard(self.groups)
         await bot.send_message(chat_id=telegram_id, text='👋 Еще раз здравствуйте! Проголосуйте пожалуйста за группу, от которой вы пришли)', reply_markup=keyboard)
 
+    @timed_query
     async def get_or_create_user(self, telegram_id, username, full_name):
-        session = self.Session()
-        try:
-            user = session.query(User).filter(
-                User.telegram_id == telegram_id).first()
-
-            if not user:
-                user = User(
-                    telegram_id=telegram_id,
-                    username=username,
-                    full_name=full_name,
-                )
-
-                if telegram_id in config.ADMIN_IDS:
-                    user.role = 'admin'
+        async with self.session() as session:
+            try:
+                user = await session.scalar(sqlalchemy.select(User).filter(
+                    User.telegram_id == telegram_id))
+
+                if not user:
+                    user = User(
+                        telegram_id=telegram_id,
+                        username=username,
+                        full_name=full_name,
+                    )
+
+                    user.role = 'admin' if telegram_id in config.ADMIN_IDS else 'user'
+
+                    session.add(user)
+                    await self._change_role_counter(session, None, user.role)
+                    await session.commit()
+
+                else:
+                    if telegram_id in config.ADMIN_IDS and user.role != 'admin':
+                        await self._change_role_counter(session, user.role or 'user', 'admin')
+                        user.role = 'admin'
+                        await session.commit()
+
+                await session.refresh(user)
+                return user
+
+            except Exception as e:
+                print(f"Ошибка в get_or_create_user: {e}")
+                await session.rollback()
+                raise
+
+    async def get_user_info(self, telegram_id, username, full_name):
+        user = self.users.get(telegram_id)
+        if user is None:
+            generation = self.users.generation(telegram_id)
+            pending = self.user_updates.pending(telegram_id)
+            user = await self.get_or_create_user(telegram_id, username, full_name)
+            user = UserInfo(user.id, user.telegram_id, user.username, user.full_name,
+                            user.role, user.subscribed)
+            # Строка в БД может отставать от еще не сброшенных изменений: и от
+            # тех, что были до чтения (их пачка могла записаться во время него),
+            # и от пришедших за время чтения
+            user = user._replace(**{**pending, **self.user_updates.pending(telegram_id)})
+            # Если роль сменили, пока шло чтение, в кэш ее не кладем
+            self.users.set(user, generation)
+        return user
 
-                session.add(user)
-                session.commit()
+    async def update_user_subscription(self, telegram_id, subscribed):
+        # Запись откладывается до сброса user_updates
+        self.user_updates.add(telegram_id, subscribed=subscribed)
+        self.users.update(telegram_id, subscribed=subscribed)
+
+    async def update_user_profile(self, telegram_id, username, full_name):
+        self.user_updates.add(telegram_id, username=username, full_name=full_name)
+        self.users.update(telegram_id, username=username, full_name=full_name)
+
+    @serialized_write
+    @timed_query
+    async def apply_user_updates(self, updates):
+        # updates: {telegram_id: {поле: значение}}. executemany требует
+        # одинаковый набор полей, поэтому строки группируются по нему
+        batches = {}
+        for telegram_id, fields in updates.items():
+            batches.setdefault(tuple(sorted(fields)), []).append(
+                {'b_telegram_id': telegram_id, **fields})
+
+        statement = sqlalchemy.update(User.__table__).where(
+            User.__table__.c.telegram_id == sqlalchemy.bindparam('b_telegram_id'))
+        async with self.session() as session:
+            for rows in batches.values():
+                await session.execute(statement, rows)
+            await session.commit()
+
+    @timed_query
+    async def get_channel_memberships(self, telegram_id):
+        async with self.session() as session:
+            rows = (await session.execute(sqlalchemy.select(
+                ChannelSubscription.channel, ChannelSubscription.is_member,
+            ).filter(ChannelSubscription.telegram_id == telegram_id))).all()
+            return dict(rows)
+
+    @timed_query
+    async def save_channel_memberships(self, telegram_id, memberships, updated_at):
+        # memberships: {канал: состоит ли}. updated_at -- наивное время в UTC
+        if not memberships:
+            return
 
-            else:
-                if telegram_id in config.ADMIN_IDS and user.role != 'admin':
-                    user.role = 'admin'
-                    session.commit()
+        statement = self._insert(ChannelSubscription).values([
+            {'telegram_id': telegram_id, 'channel': channel,
+             'is_member': is_member, 'updated_at': updated_at}
+            for channel, is_member in memberships.items()
+        ])
+        statement = statement.on_conflict_do_update(
+            index_elements=[ChannelSubscription.telegram_id, ChannelSubscription.channel],
+            set_={'is_member': statement.excluded.is_member,
+                  'updated_at': statement.excluded.updated_at},
+            where=ChannelSubscription.updated_at <= statement.excluded.updated_at,
+        )
 
-            session.refresh(user)
-            return user
+        # users.subscribed -- подписан на все каналы из конфига
+        channels = [channel.lower() for channel in config.CHANNEL_USERNAMES]
+        member_of = sqlalchemy.select(sqlalchemy.func.count()).where(
+            ChannelSubscription.telegram_id == telegram_id,
+            ChannelSubscription.channel.in_(channels),
+            ChannelSubscription.is_member == True,
+        ).scalar_subquery()
+
+        async with self.session() as session:
+            await session.execute(statement)
+            row = (await session.execute(sqlalchemy.select(User.subscribed, member_of).where(
+                User.telegram_id == telegram_id))).first()
+            await session.commit()
+
+        # Сам флаг пишется через user_updates, как и из middleware: иначе
+        # запоздавшая пачка могла бы затереть его старым значением
+        if row is None:
+            return
+        stored = self.user_updates.pending(telegram_id).get('subscribed', row[0])
+        subscribed = row[1] == len(channels)
+        if subscribed != stored:
+            await self.update_user_subscription(telegram_id, subscribed)
 
-        except Exception as e:
-            print(f"Ошибка в get_or_create_user: {e}")
-            session.rollback()
-            raise
-        finally:
-            session.close()  # Всегда закрываем сессию
+    @timed_query
+    async def get_user_telegram_ids(self, after=None, limit=100):
+        query = sqlalchemy.select(User.telegram_id).order_by(User.telegram_id).limit(limit)
+        if after is not None:
+            query = query.filter(User.telegram_id > after)
 
-    async def update_user_subscription(self, telegram_id, subscribed):
-        session = self._get_session()
-        user = session.query(User).filter(User.telegram_id == telegram_id)
-        if user:
-            user = user.first()
-            user.subscribed = subscribed
-            session.commit()
-        session.close()
-        return
+        async with self.session(read_only=True) as session:
+            return (await session.scalars(query)).all()
 
+    @timed_query
     async def get_active_concerts(self, user_id=None):
-        session = self._get_session()
         current_time = datetime.datetime.now()
         one_day_ago = current_time - datetime.timedelta(days=1)
 
-        concerts = session.query(Concert).filter(
+        query = sqlalchemy.select(Concert).options(
+            sqlalchemy.orm.selectinload(Concert.photos),
+        ).filter(
             Concert.is_active == True,
             Concert.date > one_day_ago,
-        ).all()
-
-        result = []
-        for concert in concerts:
-            if user_id:
-                existing_ticket = session.query(Ticket).filter(
-                    Ticket.user_id == user_id,
-                    Ticket.concert_id == concert.id
-                ).first()
-
-                if existing_ticket:
-                    continue
-
-            photos = json.loads(concert.photos) if concert.photos else []
-            result.append({
-                'id': concert.id,
-                'name': concert.name,
-                'description': concert.description,
-                'date': concert.date,
-                'address': concert.address,
-                'photos': photos,
-                'is_active': concert.is_active,
-            })
-        session.close()
-        return result
+        ).order_by(Concert.date)
+
+        if user_id:
+            # Концерты, на которые у пользователя уже есть билет, отсекаются в том же запросе
+            query = query.filter(~sqlalchemy.exists().where(
+                Ticket.concert_id == Concert.id,
+                Ticket.user_id == user_id,
+            ))
 
+        async with self.session() as session:
+            concerts = (await session.scalars(query)).all()
+            return [self._concert_to_dict(concert) for concert in concerts]
+
+    @serialized_write
+    @timed_query
     async def create_ticket(self, user_id, concert_id):
-        session = self._get_session()
-        existing_ticket = session.query(Ticket).filter_by(
-            user_id=user_id, concert_id=concert_id).first()
-        if existing_ticket:
-            return {
-                'id': existing_ticket.id,
-                'code': existing_ticket.code,
-                'is_used': existing_ticket.is_used
-            }
+        for attempt in range(TICKET_CODE_ATTEMPTS):
+            code = self.generate_ticket_code()
+            async with self.session() as session:
+                try:
+                    # Один INSERT: при повторном нажатии конфликт по (user_id, concert_id)
+                    # просто ничего не вставит, и вернется уже выданный билет
+                    ticket = (await session.execute(
+                        self._insert(Ticket).values(
+                            user_id=user_id,
+                            concert_id=concert_id,
+                            code=code,
+                            code_normalized=normalize_code(code),
+                        ).on_conflict_do_nothing(
+                            index_elements=[Ticket.user_id, Ticket.concert_id],
+                        ).returning(Ticket.id, Ticket.code, Ticket.is_used))).first()
+
+                    if ticket is not None:
+                        await self._bump_counter(session, 'tickets_issued', concert_id)
+                        await session.commit()
+                    else:
+                        self.ticket_codes.put_back(code)
+                        ticket = (await session.execute(sqlalchemy.select(
+                            Ticket.id, Ticket.code, Ticket.is_used,
+                        ).filter_by(user_id=user_id, concert_id=concert_id))).first()
 
-        ticket = Ticket(
-            user_id=user_id,
-            concert_id=concert_id,
-            code=self.generate_ticket_code(),
-        )
-        session.add(ticket)
-        session.commit()
-        session.refresh(ticket)
-        session.close()
+                    return {
+                        'id': ticket.id,
+                        'code': ticket.code,
+                        'is_used': ticket.is_used
+                    }
 
-        return {
-            'id': ticket.id,
-            'code': ticket.code,
-            'is_used': ticket.is_used
-        }
+                except sqlalchemy.exc.IntegrityError:
+                    # Совпал код билета -- пробуем еще раз с новым
+                    await session.rollback()
 
+        raise RuntimeError(
+            f'Не удалось сгенерировать уникальный код билета за {TICKET_CODE_ATTEMPTS} попыток')
+
+    @timed_query
     async def get_user_tickets(self, user_id):
-        session = self._get_session()
-        tickets = session.query(Ticket).options(
-            sqlalchemy.orm.joinedload(Ticket.concert),
-        ).filter_by(user_id=user_id)
-        if tickets:
-            tickets = tickets.all()
-        else:
-            return
+        async with self.session() as session:
+            tickets = (await session.scalars(
+                sqlalchemy.select(Ticket).options(
+                    sqlalchemy.orm.joinedload(Ticket.concert),
+                ).filter_by(user_id=user_id))).all()
 
-        result = []
-        for ticket in tickets:
-            result.append({
-                'concert_name': ticket.concert.name,
-                'concert_date': ticket.concert.date,
-                'concert_id': ticket.concert.id,
-            })
+            result = []
+            for ticket in tickets:
+                result.append({
+                    'concert_name': ticket.concert.name,
+                    'concert_date': ticket.concert.date,
+                    'concert_id': ticket.concert.id,
+                })
 
-        session.close()
-        return result
+            return result
 
+    @timed_query
     async def get_user_ticket(self, user_id, concert_id):
-        session = self._get_session()
-        ticket = session.query(Ticket).options(
-            sqlalchemy.orm.joinedload(Ticket.concert),
-        ).filter_by(user_id=user_id, concert_id=concert_id)
-        if ticket:
-            ticket = ticket.first()
-        else:
-            return
-
-        photos = json.loads(
-            ticket.concert.photos) if ticket.concert.photos else []
-        result = {
-            'concert_name': ticket.concert.name,
-            'concert_date': ticket.concert.date,
-            'concert_photos': photos,
-            'code': ticket.code,
-            'is_used': ticket.is_used,
-            'used_at': ticket.used_at
-        }
+        async with self.session() as session:
+            ticket = await session.scalar(
+                sqlalchemy.select(Ticket).options(
+                    sqlalchemy.orm.joinedload(Ticket.concert).selectinload(Concert.photos),
+                ).filter_by(user_id=user_id, concert_id=concert_id))
+            if not ticket:
+                return None
 
-        session.close()
-        return result
+            return {
+                'concert_name': ticket.concert.name,
+                'concert_date': ticket.concert.date,
+                'concert_photos': [photo.file_id for photo in ticket.concert.photos],
+                'code': ticket.code,
+                'is_used': ticket.is_used,
+                'used_at': ticket.used_at
+            }
 
+    @timed_query
     async def get_all_concerts(self):
-        session = self._get_session()
-        concerts = session.query(Concert).order_by(Concert.date.desc()).all()
-        result = []
-        for concert in concerts:
-            photos = json.loads(concert.photos) if concert.photos else []
-            result.append({
-                'id': concert.id,
-                'name': concert.name,
-                'description': concert.description,
-                'date': concert.date,
-                'address': concert.address,
-                'photos': photos,
-                'is_active': concert.is_active
-            })
-        session.close()
-        return result
-
+        async with self.session() as session:
+            concerts = (await session.scalars(
+                sqlalchemy.select(Concert).options(
+                    sqlalchemy.orm.selectinload(Concert.photos),
+                ).order_by(Concert.date.desc()))).all()
+            return [self._concert_to_dict(concert) for concert in concerts]
+
+    @timed_query
     async def get_concert_by_id(self, concert_id):
-        session = self._get_session()
-        concert = session.query(Concert).filter_by(id=concert_id).first()
-        if concert:
-            photos = json.loads(concert.photos) if concert.photos else []
-            session.close()
-            return {
-                'id': concert.id,
-                'name': concert.name,
-                'description': concert.description,
-                'date': concert.date,
-                'address': concert.address,
-                'photos': photos,
-                'is_active': concert.is_active
-            }
-        session.close()
-        return None
+        async with self.session() as session:
+            concert = await session.get(Concert, concert_id, options=[
+                sqlalchemy.orm.selectinload(Concert.photos)])
+            if not concert:
+                return None
 
+            return self._concert_to_dict(concert)
+
+    @timed_query
     async def toggle_concert_active(self, concert_id):
-        session = self._get_session()
-        concert = session.query(Concert).filter_by(id=concert_id).first()
-        if concert:
+        async with self.session() as session:
+            concert = await session.get(Concert, concert_id)
+            if not concert:
+                return None
+
             concert.is_active = not concert.is_active
             status = concert.is_active
-            session.commit()
-            session.close()
+            await session.commit()
             return status
-        session.close()
-        return None
 
+    @timed_query
     async def update_concert_field(self, concert_id, field, new_value):
-        session = self._get_session()
-        concert = session.query(Concert).filter_by(id=concert_id).first()
-        if not concert:
-            return False
-
-        if field == 'name':
-            concert.name = new_value
-        elif field == 'description':
-            concert.description = new_value
-        elif field == 'date':
-            concert.date = new_value
-        elif field == 'address':
-            concert.address = new_value
-        else:
-            session.close()
+        if field not in ('name', 'description', 'date', 'address'):
             return False
 
-        session.commit()
-        session.close()
-        return True
+        async with self.session() as session:
+            concert = await session.get(Concert, concert_id)
+            if not concert:
+                return False
 
-    async def update_concert_photos(self, concert_id, photo_ids):
-        session = self._get_session()
-        concert = session.query(Concert).filter_by(id=concert_id).first()
-        if not concert:
-            return False
+            setattr(concert, field, new_value)
+            await session.commit()
+            return True
 
-        import json
-        concert.photos = json.dumps(photo_ids)
+    @timed_query
+    async def update_concert_photos(self, concert_id, photos):
+        async with self.session() as session:
+            concert = await session.get(Concert, concert_id, options=[
+                sqlalchemy.orm.selectinload(Concert.photos)])
+            if not concert:
+                return False
 
-        session.commit()
-        return True
+            # Оставшиеся фото обновляются, только если изменились position/file_id,
+            # новые вставляются, а пропавшие удаляет delete-orphan
+            existing = {self._photo_key(photo.file_id, photo.file_unique_id): photo
+                        for photo in concert.photos}
+            updated = []
+            for position, photo in enumerate(photos):
+                row = existing.pop(self._photo_key(
+                    photo['file_id'], photo.get('file_unique_id')), None)
+                if row is None:
+                    row = ConcertPhoto(file_id=photo['file_id'],
+                                       file_unique_id=photo.get('file_unique_id'))
+                row.position = position
+                row.file_id = photo['file_id']
+                updated.append(row)
+            concert.photos = updated
+
+            await session.commit()
+            return True
 
     async def is_valid_concert_date(self, date):
         now = datetime.datetime.now()
@@ -372,38 +775,37 @@ class Database:
 
         return True, '✅ Дата корректна'
 
+    @timed_query
     async def create_concert(self, name, description, date, address, photos):
-        session = self._get_session()
-        photos_json = json.dumps(photos) if photos else '[]'
         concert = Concert(
             name=name,
             description=description,
             date=date,
             address=address,
-            photos=photos_json,
+            photos=[ConcertPhoto(position=position,
+                                 file_id=photo['file_id'],
+                                 file_unique_id=photo.get('file_unique_id'))
+                    for position, photo in enumerate(photos or [])],
             is_active=False,
         )
-        session.add(concert)
-        session.commit()
-        session.refresh(concert)
-        return concert
-
-    async def get_all_users(self):
-        session = self._get_session()
-        try:
-            users = session.query(User).all()
-            return users
-        finally:
-            session.close()
-
-    async def get_all_subscribed_users(self):
-        session = self._get_session()
-        try:
-            users = session.query(User).filter(
-                User.subscribed == True, User.role.in_(['member', 'user'])).all()
-            return users
-        finally:
-            session.close()
+        async with self.session() as session:
+            session.add(concert)
+            await session.commit()
+            await session.refresh(concert)
+            return concert
+
+    @timed_query
+    async def get_all_users(self, use_primary=False):
+        async with self.session(read_only=not use_primary) as session:
+            users = await session.scalars(sqlalchemy.select(User))
+            return users.all()
+
+    @timed_query
+    async def get_all_subscribed_users(self, use_primary=False):
+        async with self.session(read_only=not use_primary) as session:
+            users = await session.scalars(sqlalchemy.select(User).filter(
+                User.subscribed == True, User.role.in_(['member', 'user'])))
+            return users.all()
 
     async def format_date_russian(self, date_obj):
         day = date_obj.day
@@ -449,327 +851,402 @@ class Database:
 
         return f'✅ Рассылка завершена. Успешно: {success_count}/{len(users)}'
 
-    async def search_users(self, search_query):
-        session = self._get_session()
-        try:
-            query = session.query(User)
-
-            if search_query.isdigit():
-                user_id = int(search_query)
-                users = query.filter(User.telegram_id == user_id).all()
-            else:
-                if search_query.startswith('@'):
-                    search_query = search_query[1:]
-
-                users_by_username = query.filter(
-                    User.username.ilike(f'%{search_query}%')
-                ).all()
+    def _search_users_query(self, search_query):
+        query = sqlalchemy.select(User)
 
-                users_by_name = query.filter(
-                    User.full_name.ilike(f'%{search_query}%')
-                ).all()
+        if search_query.isdigit():
+            return query.filter(User.telegram_id == int(search_query))
 
-                users = list(
-                    {u.id: u for u in users_by_username + users_by_name}.values())
+        # @username ищется по началу ника, остальное -- по нику и имени
+        by_username = search_query.startswith('@')
+        search_query = search_query.lstrip('@')
 
-            result = []
-            for user in users:
-                result.append({
-                    'id': user.id,
-                    'telegram_id': user.telegram_id,
-                    'username': user.username,
-                    'full_name': user.full_name,
-                    'role': user.role,
-                    'subscribed': user.subscribed
-                })
-
-            return result
-
-        except Exception as e:
-            print(f'Ошибка при поиске пользователей: {e}')
+        if self.search_backend == 'fts5':
+            tokens = re.findall(r'\w+', search_query)
+            if not tokens:
+                return None
+            match = ' '.join(f'"{token}"*' for token in tokens)
+            if by_username:
+                match = f'username : ({match})'
+            return query.join(users_fts, users_fts.c.rowid == User.id).filter(
+                sqlalchemy.literal_column('users_fts').op('MATCH')(match),
+            ).order_by(users_fts.c.rank)
+
+        if by_username:
+            return query.filter(
+                User.username.istartswith(search_query, autoescape=True),
+            ).order_by(User.username)
+
+        query = query.filter(sqlalchemy.or_(
+            User.username.icontains(search_query, autoescape=True),
+            User.full_name.icontains(search_query, autoescape=True),
+        ))
+        if self.search_backend == 'trgm':
+            # ILIKE отрабатывает по GIN-индексам pg_trgm, ранжируем по похожести
+            return query.order_by(sqlalchemy.func.greatest(
+                sqlalchemy.func.similarity(User.username, search_query),
+                sqlalchemy.func.similarity(User.full_name, search_query),
+            ).desc())
+        return query.order_by(User.full_name)
+
+    @timed_query
+    async def search_users(self, search_query, role=None, use_primary=False):
+        query = self._search_users_query(search_query.strip())
+        if query is None:
             return []
-        finally:
-            session.close()
-
+        if role is not None:
+            query = query.filter(User.role == role)
+
+        async with self.session(read_only=not use_primary) as session:
+            try:
+                users = (await session.scalars(
+                    query.limit(config.SEARCH_RESULTS_LIMIT))).all()
+
+                result = []
+                for user in users:
+                    result.append({
+                        'id': user.id,
+                        'telegram_id': user.telegram_id,
+                        'username': user.username,
+                        'full_name': user.full_name,
+                        'role': user.role,
+                        'subscribed': user.subscribed
+                    })
+
+                return result
+
+            except Exception as e:
+                print(f'Ошибка при поиске пользователей: {e}')
+                return []
+
+    @timed_query
     async def update_user_role(self, telegram_id, new_role):
-        session = self._get_session()
-        try:
-            user = session.query(User).filter(
-                User.telegram_id == telegram_id).first()
+        async with self.session() as session:
+            try:
+                user = await session.scalar(sqlalchemy.select(User).filter(
+                    User.telegram_id == telegram_id))
 
-            if not user:
-                print(f'Пользователь с ID {telegram_id} не найден')
-                return False
+                if not user:
+                    print(f'Пользователь с ID {telegram_id} не найден')
+                    return False
 
-            if telegram_id in config.ADMIN_IDS:
-                print(
-                    f'Пользователь {telegram_id} является системным админом, роль не может быть изменена')
-                user.role = 'admin'
-                session.commit()
-                session.refresh(user)
-                return False
+                if telegram_id in config.ADMIN_IDS:
+                    print(
+                        f'Пользователь {telegram_id} является системным админом, роль не может быть изменена')
+                    await self._change_role_counter(session, user.role or 'user', 'admin')
+                    user.role = 'admin'
+                    await session.commit()
+                    return False
 
-            valid_roles = ['user', 'member', 'leading', 'checker', 'admin']
-            if new_role not in valid_roles:
-                print(f'Некорректная роль: {new_role}')
-                return False
+                valid_roles = ['user', 'member', 'leading', 'checker', 'admin']
+                if new_role not in valid_roles:
+                    print(f'Некорректная роль: {new_role}')
+                    return False
 
-            user.role = new_role
-            session.commit()
+                await self._change_role_counter(session, user.role or 'user', new_role)
+                user.role = new_role
+                await session.commit()
 
-            print(f'Роль пользователя {telegram_id} изменена на {new_role}')
-            return True
+                print(f'Роль пользователя {telegram_id} изменена на {new_role}')
+                return True
 
-        except Exception as e:
-            print(f'Ошибка при обновлении роли: {e}')
-            session.rollback()
-            return False
-        finally:
-            session.close()
-
-    async def get_users_by_role(self, role):
-        session = self._get_session()
-        try:
-            users = session.query(User).filter(User.role == role).all()
-
-            result = []
-            for user in users:
-                result.append({
-                    'id': user.id,
-                    'telegram_id': user.telegram_id,
-                    'username': user.username,
-                    'full_name': user.full_name,
-                    'role': user.role,
-                    'subscribed': user.subscribed,
-                    'created_at': user.created_at
-                })
+            except Exception as e:
+                print(f'Ошибка при обновлении роли: {e}')
+                await session.rollback()
+                return False
 
-            return result
+            finally:
+                # Роль могла поменяться, даже если вернули False (системный админ)
+                self.users.invalidate(telegram_id)
+
+    @timed_query
+    async def get_users_by_role(self, role, cursor=None, direction='next', page_size=None,
+                                use_primary=False):
+        page_size = page_size or config.ROLE_LIST_PAGE_SIZE
+        key = sqlalchemy.tuple_(User.created_at, User.id)
+
+        # Keyset-пагинация по индексу (role, created_at, id): страница читается
+        # одним запросом без OFFSET, лишняя строка показывает, есть ли продолжение
+        query = sqlalchemy.select(User).filter(User.role == role)
+        if direction == 'prev':
+            if cursor:
+                query = query.filter(key < decode_users_cursor(cursor))
+            query = query.order_by(User.created_at.desc(), User.id.desc())
+        else:
+            if cursor:
+                query = query.filter(key > decode_users_cursor(cursor))
+            query = query.order_by(User.created_at, User.id)
+
+        async with self.session(read_only=not use_primary) as session:
+            try:
+                users = (await session.scalars(query.limit(page_size + 1))).all()
+
+                has_more = len(users) > page_size
+                users = users[:page_size]
+                if direction == 'prev':
+                    users.reverse()
+                    has_prev, has_next = has_more, True
+                else:
+                    has_prev, has_next = cursor is not None, has_more
+
+                result = []
+                for user in users:
+                    result.append({
+                        'id': user.id,
+                        'telegram_id': user.telegram_id,
+                        'username': user.username,
+                        'full_name': user.full_name,
+                        'role': user.role,
+                        'subscribed': user.subscribed,
+                        'created_at': user.created_at
+                    })
+
+                return {
+                    'users': result,
+                    'prev_cursor': encode_users_cursor(users[0]) if users and has_prev else None,
+                    'next_cursor': encode_users_cursor(users[-1]) if users and has_next else None,
+                }
 
-        except Exception as e:
-            print(f'Ошибка при получении пользователей по роли: {e}')
-            return []
-        finally:
-            session.close()
+            except Exception as e:
+                print(f'Ошибка при получении пользователей по роли: {e}')
+                return {'users': [], 'prev_cursor': None, 'next_cursor': None}
 
+    @timed_query
     async def get_ticket_by_code(self, code):
-        session = self.Session()
-        try:
-            ticket = session.query(Ticket).options(
-                sqlalchemy.orm.joinedload(Ticket.user),
-                sqlalchemy.orm.joinedload(Ticket.concert)
-            ).filter(Ticket.code == code).first()
+        async with self.session() as session:
+            try:
+                ticket = await session.scalar(sqlalchemy.select(Ticket).options(
+                    sqlalchemy.orm.joinedload(Ticket.user),
+                    sqlalchemy.orm.joinedload(Ticket.concert)
+                ).filter(
+                    Ticket.code_normalized == normalize_code(code),
+                ).order_by(
+                    # У старых кодов нормализация может совпасть -- точное совпадение первым
+                    (Ticket.code == code.strip()).desc(),
+                ).limit(1))
+
+                if not ticket:
+                    return None
+
+                return {
+                    'id': ticket.id,
+                    'code': ticket.code,
+                    'is_used': ticket.is_used,
+                    'used_at': ticket.used_at,
+                    'user_name': ticket.user.full_name if ticket.user else 'Неизвестно',
+                    'user_username': ticket.user.username if ticket.user and ticket.user.username else None,
+                    'concert_name': ticket.concert.name,
+                    'concert_date': ticket.concert.date
+                }
 
-            if not ticket:
+            except Exception as e:
+                print(f'Ошибка при поиске билета: {e}')
                 return None
 
-            return {
-                'id': ticket.id,
-                'code': ticket.code,
-                'is_used': ticket.is_used,
-                'used_at': ticket.used_at,
-                'user_name': ticket.user.full_name if ticket.user else 'Неизвестно',
-                'user_username': ticket.user.username if ticket.user and ticket.user.username else None,
-                'concert_name': ticket.concert.name,
-                'concert_date': ticket.concert.date
-            }
-
-        except Exception as e:
-            print(f'Ошибка при поиске билета: {e}')
-            return None
-        finally:
-            session.close()
-
-    async def mark_ticket_as_used(self, ticket_id):
-        session = self.Session()
-        try:
-            ticket = session.query(Ticket).filter(
-                Ticket.id == ticket_id).first()
-
-            if not ticket:
-                return False
-
-            if ticket.is_used:
-                return False
-
-            ticket.is_used = True
-            ticket.used_at = datetime.datetime.now()
-            session.commit()
-
-            return True
-
-        except Exception as e:
-            print(f'Ошибка при отметке билета: {e}')
-            session.rollback()
-            return False
-        finally:
-            session.close()
-
-    async def get_concerts_statistics(self):
-        session = self.Session()
-        try:
-            # Общая статистика по концертам
-            total_concerts = session.query(Concert).count()
-            active_concerts = session.query(Concert).filter(
-                Concert.is_active == True).count()
-            inactive_concerts = total_concerts - active_concerts
-
-            # Статистика по билетам
-            total_tickets = session.query(Ticket).count()
-            used_tickets = session.query(Ticket).filter(
-                Ticket.is_used == True).count()
-            active_tickets = total_tickets - used_tickets
-
-            # Самый популярный концерт
-            popular_concert = session.query(
-                Concert.name,
-                Concert.id,
-                sqlalchemy.func.count(Ticket.id).label('tickets_count')
-            ).join(Ticket, Concert.id == Ticket.concert_id)\
-                .group_by(Concert.id)\
-                .order_by(sqlalchemy.desc('tickets_count'))\
-                .first()
-
-            # Концерты по статусу
-            concerts_by_status = session.query(
-                Concert.name,
-                Concert.is_active,
-                sqlalchemy.func.count(Ticket.id).label('tickets_count')
-            ).outerjoin(Ticket, Concert.id == Ticket.concert_id)\
-                .group_by(Concert.id)\
-                .order_by(Concert.is_active.desc(), Concert.date.desc())\
-                .all()
-
-            popular_concert_info = None
-            if popular_concert:
-                popular_concert_info = {
-                    'name': popular_concert[0],
-                    'tickets_count': popular_concert[2]
+    @serialized_write
+    @timed_query
+    async def mark_ticket_as_used(self, ticket_id, checker_telegram_id=None):
+        async with self.session() as session:
+            try:
+                checker_id = sqlalchemy.select(User.id).filter(
+                    User.telegram_id == checker_telegram_id).scalar_subquery()
+
+                # Проверка и отметка одним UPDATE: из нескольких проверяющих,
+                # отсканировавших один код, строку обновит только первый
+                marked = (await session.execute(
+                    sqlalchemy.update(Ticket).where(
+                        Ticket.id == ticket_id,
+                        Ticket.is_used.is_not(True),
+                    ).values(
+                        is_used=True,
+                        used_at=datetime.datetime.now(),
+                        used_by_id=checker_id,
+                    ).returning(Ticket.concert_id, Ticket.used_at))).first()
+
+                if marked is not None:
+                    await self._bump_counter(session, 'tickets_used', marked.concert_id)
+                    await session.commit()
+                    return True, f'✅ Билет отмечен как использованный в {marked.used_at:%H:%M}!'
+
+                checker = sqlalchemy.orm.aliased(User)
+                ticket = (await session.execute(sqlalchemy.select(
+                    Ticket.used_at, checker.username, checker.full_name,
+                ).outerjoin(checker, checker.id == Ticket.used_by_id).filter(
+                    Ticket.id == ticket_id))).first()
+
+                if not ticket:
+                    return False, '❌ Билет не найден'
+
+                used_at = f' в {ticket.used_at:%H:%M}' if ticket.used_at else ''
+                used_by = ''
+                if ticket.username:
+                    used_by = f', проверяющий @{ticket.username}'
+                elif ticket.full_name:
+                    used_by = f', проверяющий {ticket.full_name}'
+                return False, f'❌ Билет уже использован{used_at}{used_by}'
+
+            except Exception as e:
+                print(f'Ошибка при отметке билета: {e}')
+                await session.rollback()
+                return False, '❌ Ошибка при отметке билета'
+
+    async def _get_concert_ticket_counts(self, session):
+        # Счетчики из stats_counters: чтение O(концертов) без сканирования tickets
+        issued = sqlalchemy.orm.aliased(StatsCounter)
+        used = sqlalchemy.orm.aliased(StatsCounter)
+        concert_key = sqlalchemy.cast(Concert.id, sqlalchemy.String)
+
+        rows = (await session.execute(sqlalchemy.select(
+            Concert.id,
+            Concert.name,
+            Concert.is_active,
+            Concert.date,
+            issued.value.label('total_tickets'),
+            used.value.label('used_tickets'),
+        ).outerjoin(issued, sqlalchemy.and_(
+            issued.name == 'tickets_issued', issued.key == concert_key,
+        )).outerjoin(used, sqlalchemy.and_(
+            used.name == 'tickets_used', used.key == concert_key,
+        )))).all()
+
+        return [{
+            'id': row.id,
+            'name': row.name,
+            'is_active': bool(row.is_active),
+            'date': row.date,
+            'total_tickets': row.total_tickets or 0,
+            'used_tickets': row.used_tickets or 0,
+        } for row in rows]
+
+    @timed_query
+    async def get_concerts_statistics(self, use_primary=False):
+        async with self.session(read_only=not use_primary) as session:
+            try:
+                concerts = await self._get_concert_ticket_counts(session)
+
+                # Общая статистика по концертам
+                total_concerts = len(concerts)
+                active_concerts = sum(1 for concert in concerts if concert['is_active'])
+                inactive_concerts = total_concerts - active_concerts
+
+                # Статистика по билетам
+                total_tickets = sum(concert['total_tickets'] for concert in concerts)
+                used_tickets = sum(concert['used_tickets'] for concert in concerts)
+                active_tickets = total_tickets - used_tickets
+
+                # Самый популярный концерт
+                popular_concert_info = None
+                with_tickets = [concert for concert in concerts if concert['total_tickets']]
+                if with_tickets:
+                    popular_concert = max(with_tickets, key=lambda c: c['total_tickets'])
+                    popular_concert_info = {
+                        'name': popular_concert['name'],
+                        'tickets_count': popular_concert['total_tickets']
+                    }
+
+                # Концерты по статусу
+                concerts.sort(key=lambda c: c['date'], reverse=True)
+                concerts.sort(key=lambda c: c['is_active'], reverse=True)
+                concerts_info = []
+                for concert in concerts:
+                    concerts_info.append({
+                        'name': concert['name'],
+                        'is_active': concert['is_active'],
+                        'tickets_count': concert['total_tickets']
+                    })
+
+                return {
+                    'total_concerts': total_concerts,
+                    'active_concerts': active_concerts,
+                    'inactive_concerts': inactive_concerts,
+                    'total_tickets': total_tickets,
+                    'used_tickets': used_tickets,
+                    'active_tickets': active_tickets,
+                    'popular_concert': popular_concert_info,
+                    'concerts_by_status': concerts_info
                 }
 
-            concerts_info = []
-            for concert in concerts_by_status:
-                concerts_info.append({
-                    'name': concert[0],
-                    'is_active': concert[1],
-                    'tickets_count': concert[2]
-                })
-
-            return {
-                'total_concerts': total_concerts,
-                'active_concerts': active_concerts,
-                'inactive_concerts': inactive_concerts,
-                'total_tickets': total_tickets,
-                'used_tickets': used_tickets,
-                'active_tickets': active_tickets,
-                'popular_concert': popular_concert_info,
-                'concerts_by_status': concerts_info
-            }
-
-        except Exception as e:
-            print(f'Ошибка при получении статистики по концертам: {e}')
-            return {}
-        finally:
-            session.close()
-
-    async def get_users_statistics(self):
-        session = self.Session()
-        try:
-            # Общая статистика по пользователям
-            total_users = session.query(User).count()
-
-            # Статистика по ролям
-            leading_count = session.query(User).filter(
-                User.role == 'leading').count()
-            checker_count = session.query(User).filter(
-                User.role == 'checker').count()
-            admin_count = session.query(User).filter(
-                User.role == 'admin').count()
-            user_count = session.query(User).filter(
-                User.role == 'user').count()
-
-            # Распределение по ролям
-            roles_distribution = []
-            roles = ['user', 'leading', 'checker', 'admin']
-
-            for role in roles:
-                count = session.query(User).filter(User.role == role).count()
-                percentage = (count / total_users *
-                              100) if total_users > 0 else 0
-                roles_distribution.append({
-                    'role': role,
-                    'count': count,
-                    'percentage': percentage
-                })
-
-            return {
-                'total_users': total_users,
-                'leading_count': leading_count,
-                'checker_count': checker_count,
-                'admin_count': admin_count,
-                'user_count': user_count,
-                'roles_distribution': roles_distribution
-            }
-
-        except Exception as e:
-            print(f'Ошибка при получении статистики по пользователям: {e}')
-            return {}
-        finally:
-            session.close()
-
-    async def get_tickets_statistics(self):
-        session = self.Session()
-        try:
-            # Общая статистика по билетам
-            total_tickets = session.query(Ticket).count()
-            used_tickets = session.query(Ticket).filter(
-                Ticket.is_used == True).count()
-            active_tickets = total_tickets - used_tickets
-
-            used_percentage = (used_tickets / total_tickets *
-                               100) if total_tickets > 0 else 0
-            active_percentage = (
-                active_tickets / total_tickets * 100) if total_tickets > 0 else 0
-
-            # Билеты по концертам
-            tickets_by_concert = session.query(
-                Concert.name,
-                Concert.id,
-                sqlalchemy.func.count(Ticket.id).label('total_tickets'),
-                sqlalchemy.func.count(
-                    sqlalchemy.case((Ticket.is_used == True, 1))
-                ).label('used_tickets'),
-                sqlalchemy.func.count(
-                    sqlalchemy.case((Ticket.is_used == False, 1))
-                ).label('active_tickets')
-            ).outerjoin(Ticket, Concert.id == Ticket.concert_id)\
-                .group_by(Concert.id)\
-                .order_by(sqlalchemy.desc('total_tickets'))\
-                .all()
-
-            concerts_info = []
-            for concert in tickets_by_concert:
-                concerts_info.append({
-                    'concert_name': concert[0],
-                    'total_tickets': concert[2] or 0,
-                    'used_tickets': concert[3] or 0,
-                    'active_tickets': concert[4] or 0
-                })
-
-            return {
-                'total_tickets': total_tickets,
-                'used_tickets': used_tickets,
-                'active_tickets': active_tickets,
-                'used_percentage': used_percentage,
-                'active_percentage': active_percentage,
-                'tickets_by_concert': concerts_info
-            }
+            except Exception as e:
+                print(f'Ошибка при получении статистики по концертам: {e}')
+                return {}
+
+    @timed_query
+    async def get_users_statistics(self, use_primary=False):
+        async with self.session(read_only=not use_primary) as session:
+            try:
+                role_counts = dict((await session.execute(sqlalchemy.select(
+                    StatsCounter.key,
+                    StatsCounter.value,
+                ).filter(StatsCounter.name == 'users_by_role'))).all())
+
+                # Общая статистика по пользователям
+                total_users = sum(role_counts.values())
+
+                # Распределение по ролям
+                roles_distribution = []
+                roles = ['user', 'leading', 'checker', 'admin']
+
+                for role in roles:
+                    count = role_counts.get(role, 0)
+                    percentage = (count / total_users *
+                                  100) if total_users > 0 else 0
+                    roles_distribution.append({
+                        'role': role,
+                        'count': count,
+                        'percentage': percentage
+                    })
+
+                return {
+                    'total_users': total_users,
+                    'leading_count': role_counts.get('leading', 0),
+                    'checker_count': role_counts.get('checker', 0),
+                    'admin_count': role_counts.get('admin', 0),
+                    'user_count': role_counts.get('user', 0),
+                    'roles_distribution': roles_distribution
+                }
 
-        except Exception as e:
-            print(f'Ошибка при получении статистики по билетам: {e}')
-            return {}
-        finally:
-            session.close()
+            except Exception as e:
+                print(f'Ошибка при получении статистики по пользователям: {e}')
+                return {}
+
+    @timed_query
+    async def get_tickets_statistics(self, use_primary=False):
+        async with self.session(read_only=not use_primary) as session:
+            try:
+                concerts = await self._get_concert_ticket_counts(session)
+
+                # Общая статистика по билетам
+                total_tickets = sum(concert['total_tickets'] for concert in concerts)
+                used_tickets = sum(concert['used_tickets'] for concert in concerts)
+                active_tickets = total_tickets - used_tickets
+
+                used_percentage = (used_tickets / total_tickets *
+                                   100) if total_tickets > 0 else 0
+                active_percentage = (
+                    active_tickets / total_tickets * 100) if total_tickets > 0 else 0
+
+                # Билеты по концертам
+                concerts.sort(key=lambda c: c['total_tickets'], reverse=True)
+                concerts_info = []
+                for concert in concerts:
+                    concerts_info.append({
+                        'concert_name': concert['name'],
+                        'total_tickets': concert['total_tickets'],
+                        'used_tickets': concert['used_tickets'],
+                        'active_tickets': concert['total_tickets'] - concert['used_tickets']
+                    })
+
+                return {
+                    'total_tickets': total_tickets,
+                    'used_tickets': used_tickets,
+                    'active_tickets': active_tickets,
+                    'used_percentage': used_percentage,
+                    'active_percentage': active_percentage,
+                    'tickets_by_concert': concerts_info
+                }
 
+            except Exception as e:
+                print(f'Ошибка при получении статистики по билетам: {e}')
+                return {}
 
 database = Database()
@@ -0,0 +1,34 @@
+import collections
+import types
+
+GroupInfo = collections.namedtuple('GroupInfo', ['id', 'name', 'position'])
+
+
+class GroupRegistry:
+    # Группы из таблицы groups, загруженные один раз при старте. Клавиатура
+    # голосования, проверка голоса и результаты берут id и порядок отсюда,
+    # поэтому callback group_<id> всегда совпадает с ключом в БД.
+    # load() целиком подменяет снимок, читатели видят либо старый, либо новый.
+
+    def __init__(self):
+        self._by_id = types.MappingProxyType({})
+        self._ordered = ()
+
+    def load(self, groups):
+        ordered = tuple(sorted(
+            (GroupInfo(group.id, group.name, group.position) for group in groups),
+            key=lambda group: (group.position, group.id)))
+        self._by_id, self._ordered = (
+            types.MappingProxyType({group.id: group for group in ordered}), ordered)
+
+    def get(self, group_id):
+        return self._by_id.get(group_id)
+
+    def __contains__(self, group_id):
+        return group_id in self._by_id
+
+    def __iter__(self):
+        return iter(self._ordered)
+
+    def __len__(self):
+        return len(self._ordered)
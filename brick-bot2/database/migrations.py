@@ -0,0 +1,317 @@
+import datetime
+import json
+
+import sqlalchemy
+
+# Каждая ревизия -- функция от синхронного соединения. Таблицы описываются
+# прямо в ревизии, а не через Base.metadata, чтобы старые ревизии не менялись
+# вместе с моделями.
+
+version_table = sqlalchemy.Table(
+    'schema_migrations', sqlalchemy.MetaData(),
+    sqlalchemy.Column('version', sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column('name', sqlalchemy.String(100), nullable=False),
+    sqlalchemy.Column('applied_at', sqlalchemy.DateTime, nullable=False),
+)
+
+
+def revision_1_initial(connection):
+    metadata = sqlalchemy.MetaData()
+
+    sqlalchemy.Table(
+        'groups', metadata,
+        sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+        sqlalchemy.Column('name', sqlalchemy.String, unique=True, nullable=False),
+        sqlalchemy.Column('points', sqlalchemy.Integer),
+    )
+    sqlalchemy.Table(
+        'users', metadata,
+        sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+        sqlalchemy.Column('telegram_id', sqlalchemy.Integer, unique=True, nullable=False),
+        sqlalchemy.Column('username', sqlalchemy.String(100)),
+        sqlalchemy.Column('full_name', sqlalchemy.String(200)),
+        sqlalchemy.Column('subscribed', sqlalchemy.Boolean),
+        sqlalchemy.Column('role', sqlalchemy.String),
+        sqlalchemy.Column('created_at', sqlalchemy.DateTime),
+    )
+    sqlalchemy.Table(
+        'votes', metadata,
+        sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+        sqlalchemy.Column('user_id', sqlalchemy.Integer,
+                          sqlalchemy.ForeignKey('users.id'), nullable=False),
+        sqlalchemy.Column('group_id', sqlalchemy.Integer,
+                          sqlalchemy.ForeignKey('groups.id'), nullable=False),
+        sqlalchemy.Column('created_at', sqlalchemy.DateTime),
+        sqlalchemy.UniqueConstraint('user_id', 'group_id', name='unique_user_group_vote'),
+    )
+    sqlalchemy.Table(
+        'concerts', metadata,
+        sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+        sqlalchemy.Column('name', sqlalchemy.String(200), nullable=False),
+        sqlalchemy.Column('description', sqlalchemy.Text),
+        sqlalchemy.Column('date', sqlalchemy.DateTime, nullable=False),
+        sqlalchemy.Column('address', sqlalchemy.Text),
+        sqlalchemy.Column('is_active', sqlalchemy.Boolean),
+        sqlalchemy.Column('photos', sqlalchemy.Text),
+        sqlalchemy.Column('created_at', sqlalchemy.DateTime),
+    )
+    sqlalchemy.Table(
+        'tickets', metadata,
+        sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+        sqlalchemy.Column('user_id', sqlalchemy.Integer, sqlalchemy.ForeignKey('users.id')),
+        sqlalchemy.Column('concert_id', sqlalchemy.Integer, sqlalchemy.ForeignKey('concerts.id')),
+        sqlalchemy.Column('code', sqlalchemy.String, unique=True, nullable=False),
+        sqlalchemy.Column('is_used', sqlalchemy.Boolean),
+        sqlalchemy.Column('used_at', sqlalchemy.DateTime),
+        sqlalchemy.Column('created_at', sqlalchemy.DateTime),
+    )
+
+    # checkfirst: базы, созданные раньше через create_all, просто получают версию 1
+    metadata.create_all(connection, checkfirst=True)
+
+
+def revision_2_hot_path_indexes(connection):
+    metadata = sqlalchemy.MetaData()
+    users = sqlalchemy.Table('users', metadata, autoload_with=connection)
+    concerts = sqlalchemy.Table('concerts', metadata, autoload_with=connection)
+    tickets = sqlalchemy.Table('tickets', metadata, autoload_with=connection)
+
+    # Перед уникальным индексом убираем дубли билетов. Оставляем использованный
+    # (иначе пропала бы отметка о входе и по второму билету пустили бы еще раз),
+    # если такого нет -- самый ранний
+    ranked = sqlalchemy.select(
+        tickets.c.id,
+        sqlalchemy.func.row_number().over(
+            partition_by=(tickets.c.user_id, tickets.c.concert_id),
+            order_by=(sqlalchemy.case((tickets.c.is_used == True, 0), else_=1),
+                      tickets.c.id),
+        ).label('rank'),
+    ).where(
+        tickets.c.user_id.is_not(None),
+        tickets.c.concert_id.is_not(None),
+    ).subquery()
+    duplicates = sqlalchemy.select(ranked.c.id).where(ranked.c.rank > 1)
+    connection.execute(tickets.delete().where(tickets.c.id.in_(duplicates)))
+
+    sqlalchemy.Index('uq_tickets_user_concert', tickets.c.user_id,
+                     tickets.c.concert_id, unique=True).create(connection)
+    sqlalchemy.Index('ix_users_role_subscribed', users.c.role,
+                     users.c.subscribed).create(connection)
+    sqlalchemy.Index('ix_concerts_active_date', concerts.c.is_active,
+                     concerts.c.date).create(connection)
+
+
+def revision_3_stats_counters(connection):
+    metadata = sqlalchemy.MetaData()
+    users = sqlalchemy.Table('users', metadata, autoload_with=connection)
+    tickets = sqlalchemy.Table('tickets', metadata, autoload_with=connection)
+    stats_counters = sqlalchemy.Table(
+        'stats_counters', metadata,
+        sqlalchemy.Column('name', sqlalchemy.String(50), primary_key=True),
+        sqlalchemy.Column('key', sqlalchemy.String(100), primary_key=True),
+        sqlalchemy.Column('value', sqlalchemy.Integer, nullable=False),
+    )
+    stats_counters.create(connection)
+    fill_stats_counters(connection, stats_counters, users, tickets)
+
+
+def fill_stats_counters(connection, stats_counters, users, tickets):
+    columns = ['name', 'key', 'value']
+    concert_key = sqlalchemy.cast(tickets.c.concert_id, sqlalchemy.String)
+    connection.execute(stats_counters.insert().from_select(columns, sqlalchemy.select(
+        sqlalchemy.literal('tickets_issued'), concert_key, sqlalchemy.func.count(),
+    ).where(tickets.c.concert_id.is_not(None)).group_by(tickets.c.concert_id)))
+    connection.execute(stats_counters.insert().from_select(columns, sqlalchemy.select(
+        sqlalchemy.literal('tickets_used'), concert_key, sqlalchemy.func.count(),
+    ).where(tickets.c.concert_id.is_not(None), tickets.c.is_used == True)
+        .group_by(tickets.c.concert_id)))
+    role = sqlalchemy.func.coalesce(users.c.role, 'user')
+    connection.execute(stats_counters.insert().from_select(columns, sqlalchemy.select(
+        sqlalchemy.literal('users_by_role'), role, sqlalchemy.func.count(),
+    ).group_by(role)))
+
+
+def revision_4_ticket_checker(connection):
+    # ADD COLUMN с REFERENCES поддерживают и SQLite, и PostgreSQL
+    connection.execute(sqlalchemy.text(
+        'ALTER TABLE tickets ADD COLUMN used_by_id INTEGER REFERENCES users (id)'))
+
+
+def revision_5_normalized_ticket_codes(connection):
+    connection.execute(sqlalchemy.text(
+        'ALTER TABLE tickets ADD COLUMN code_normalized VARCHAR'))
+
+    metadata = sqlalchemy.MetaData()
+    tickets = sqlalchemy.Table('tickets', metadata, autoload_with=connection)
+
+    # То же, что ticket_codes.normalize_code: верхний регистр, O -> 0, I/L -> 1
+    normalized = sqlalchemy.func.upper(tickets.c.code)
+    for confusable, replacement in (('O', '0'), ('I', '1'), ('L', '1')):
+        normalized = sqlalchemy.func.replace(normalized, confusable, replacement)
+    connection.execute(tickets.update().values(code_normalized=normalized))
+
+    sqlalchemy.Index('ix_tickets_code_normalized',
+                     tickets.c.code_normalized).create(connection)
+
+
+def revision_6_concert_photos(connection):
+    metadata = sqlalchemy.MetaData()
+    concerts = sqlalchemy.Table('concerts', metadata, autoload_with=connection)
+    concert_photos = sqlalchemy.Table(
+        'concert_photos', metadata,
+        sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+        sqlalchemy.Column('concert_id', sqlalchemy.Integer,
+                          sqlalchemy.ForeignKey('concerts.id', ondelete='CASCADE'),
+                          nullable=False),
+        sqlalchemy.Column('position', sqlalchemy.Integer, nullable=False),
+        sqlalchemy.Column('file_id', sqlalchemy.String, nullable=False),
+        sqlalchemy.Column('file_unique_id', sqlalchemy.String),
+        sqlalchemy.Index('ix_concert_photos_concert_position', 'concert_id', 'position'),
+    )
+    concert_photos.create(connection)
+
+    # Переносим JSON-списки file_id; file_unique_id у старых фото неизвестен
+    rows = []
+    for concert_id, photos in connection.execute(sqlalchemy.select(
+            concerts.c.id, concerts.c.photos).where(concerts.c.photos.is_not(None))):
+        try:
+            file_ids = json.loads(photos)
+        except ValueError:
+            print(f'Не удалось разобрать фото концерта {concert_id}: {photos}')
+            continue
+        rows.extend({'concert_id': concert_id, 'position': position,
+                     'file_id': file_id, 'file_unique_id': None}
+                    for position, file_id in enumerate(file_ids))
+    if rows:
+        connection.execute(concert_photos.insert(), rows)
+
+    connection.execute(sqlalchemy.text('ALTER TABLE concerts DROP COLUMN photos'))
+
+
+def revision_7_user_search_index(connection):
+    dialect = connection.dialect.name
+
+    if dialect == 'sqlite':
+        if not connection.exec_driver_sql(
+                "SELECT sqlite_compileoption_used('ENABLE_FTS5')").scalar():
+            print('SQLite собран без FTS5, поиск пользователей останется на LIKE')
+            return
+
+        # Внешний контент: индекс хранит только токены, строки остаются в users
+        connection.exec_driver_sql(
+            "CREATE VIRTUAL TABLE users_fts USING fts5("
+            "username, full_name, content='users', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2')")
+        connection.exec_driver_sql(
+            "CREATE TRIGGER users_fts_insert AFTER INSERT ON users BEGIN "
+            "INSERT INTO users_fts (rowid, username, full_name) "
+            "VALUES (new.id, new.username, new.full_name); END")
+        connection.exec_driver_sql(
+            "CREATE TRIGGER users_fts_delete AFTER DELETE ON users BEGIN "
+            "INSERT INTO users_fts (users_fts, rowid, username, full_name) "
+            "VALUES ('delete', old.id, old.username, old.full_name); END")
+        connection.exec_driver_sql(
+            "CREATE TRIGGER users_fts_update AFTER UPDATE OF username, full_name ON users BEGIN "
+            "INSERT INTO users_fts (users_fts, rowid, username, full_name) "
+            "VALUES ('delete', old.id, old.username, old.full_name); "
+            "INSERT INTO users_fts (rowid, username, full_name) "
+            "VALUES (new.id, new.username, new.full_name); END")
+        connection.exec_driver_sql("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+
+    elif dialect == 'postgresql':
+        try:
+            # Без прав на CREATE EXTENSION миграция не должна падать целиком
+            with connection.begin_nested():
+                connection.exec_driver_sql('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        except sqlalchemy.exc.DBAPIError as e:
+            print(f'Не удалось включить pg_trgm, поиск пользователей останется на ILIKE: {e}')
+            return
+
+        connection.exec_driver_sql(
+            'CREATE INDEX ix_users_username_trgm ON users USING gin (username gin_trgm_ops)')
+        connection.exec_driver_sql(
+            'CREATE INDEX ix_users_full_name_trgm ON users USING gin (full_name gin_trgm_ops)')
+
+
+def revision_8_users_role_created_index(connection):
+    metadata = sqlalchemy.MetaData()
+    users = sqlalchemy.Table('users', metadata, autoload_with=connection)
+
+    # Для постраничных списков по ролям: курсор (created_at, id) внутри роли.
+    # Ключ курсора не должен быть NULL, иначе строка выпадет из всех страниц
+    connection.execute(users.update().where(users.c.created_at.is_(None)).values(
+        created_at=datetime.datetime(1970, 1, 1)))
+    sqlalchemy.Index('ix_users_role_created', users.c.role, users.c.created_at,
+                     users.c.id).create(connection)
+
+
+def revision_9_group_position(connection):
+    connection.execute(sqlalchemy.text(
+        'ALTER TABLE groups ADD COLUMN position INTEGER NOT NULL DEFAULT 0'))
+
+    # Группы создавались в порядке config.groups, этот порядок и сохраняем
+    metadata = sqlalchemy.MetaData()
+    groups = sqlalchemy.Table('groups', metadata, autoload_with=connection)
+    connection.execute(groups.update().values(position=groups.c.id))
+
+
+def revision_10_channel_subscriptions(connection):
+    sqlalchemy.Table(
+        'channel_subscriptions', sqlalchemy.MetaData(),
+        sqlalchemy.Column('telegram_id', sqlalchemy.BigInteger, primary_key=True),
+        sqlalchemy.Column('channel', sqlalchemy.String(100), primary_key=True),
+        sqlalchemy.Column('is_member', sqlalchemy.Boolean, nullable=False),
+        sqlalchemy.Column('updated_at', sqlalchemy.DateTime, nullable=False),
+    ).create(connection)
+
+
+MIGRATIONS = [
+    (1, 'initial', revision_1_initial),
+    (2, 'hot_path_indexes', revision_2_hot_path_indexes),
+    (3, 'stats_counters', revision_3_stats_counters),
+    (4, 'ticket_checker', revision_4_ticket_checker),
+    (5, 'normalized_ticket_codes', revision_5_normalized_ticket_codes),
+    (6, 'concert_photos', revision_6_concert_photos),
+    (7, 'user_search_index', revision_7_user_search_index),
+    (8, 'users_role_created_index', revision_8_users_role_created_index),
+    (9, 'group_position', revision_9_group_position),
+    (10, 'channel_subscriptions', revision_10_channel_subscriptions),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(connection):
+    if not sqlalchemy.inspect(connection).has_table(version_table.name):
+        return 0
+    version = connection.scalar(
+        sqlalchemy.select(sqlalchemy.func.max(version_table.c.version)))
+    return version or 0
+
+
+def search_backend(connection):
+    # Ревизия 7 создает индекс, только если СУБД его поддерживает
+    inspector = sqlalchemy.inspect(connection)
+    if connection.dialect.name == 'sqlite' and inspector.has_table('users_fts'):
+        return 'fts5'
+    if connection.dialect.name == 'postgresql' and any(
+            index['name'] == 'ix_users_username_trgm'
+            for index in inspector.get_indexes('users')):
+        return 'trgm'
+    return 'like'
+
+
+def upgrade(connection, target=None):
+    target = LATEST_VERSION if target is None else target
+    version_table.create(connection, checkfirst=True)
+    version = current_version(connection)
+
+    applied = []
+    for number, name, migrate in MIGRATIONS:
+        if number <= version or number > target:
+            continue
+        migrate(connection)
+        connection.execute(version_table.insert().values(
+            version=number, name=name, applied_at=datetime.datetime.now()))
+        applied.append(number)
+    return applied
@@ -33,6 +33,8 @@ class Group(Base):
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
     name = sqlalchemy.Column(sqlalchemy.String, unique=True, nullable=False)
     points = sqlalchemy.Column(sqlalchemy.Integer, default=0)
+    # Порядок кнопок в клавиатуре голосования и строк в результатах
+    position = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
     
     # Исправьте на правильное имя класса
     votes = sqlalchemy.orm.relationship("Vote", back_populates="group")
@@ -49,9 +51,15 @@ class User(Base):
     role = sqlalchemy.Column(sqlalchemy.String, default='user')
     created_at = sqlalchemy.Column(sqlalchemy.DateTime, default=datetime.datetime.now)
 
+    __table_args__ = (
+        sqlalchemy.Index('ix_users_role_subscribed', 'role', 'subscribed'),
+        sqlalchemy.Index('ix_users_role_created', 'role', 'created_at', 'id'),
+    )
+
     # Исправьте на правильное имя класса
     votes = sqlalchemy.orm.relationship("Vote", back_populates="user")
-    tickets = sqlalchemy.orm.relationship('Ticket', back_populates='user')
+    tickets = sqlalchemy.orm.relationship('Ticket', back_populates='user',
+                                          foreign_keys='Ticket.user_id')
 
 
 class Concert(Base):
@@ -63,10 +71,33 @@ class Concert(Base):
     date = sqlalchemy.Column(sqlalchemy.DateTime, nullable=False)
     address = sqlalchemy.Column(sqlalchemy.Text)
     is_active = sqlalchemy.Column(sqlalchemy.Boolean, default=False)
-    photos = sqlalchemy.Column(sqlalchemy.Text)
     created_at = sqlalchemy.Column(sqlalchemy.DateTime, default=datetime.datetime.now)
+
+    __table_args__ = (sqlalchemy.Index('ix_concerts_active_date', 'is_active', 'date'),)
     
     tickets = sqlalchemy.orm.relationship('Ticket', back_populates="concert")
+    photos = sqlalchemy.orm.relationship('ConcertPhoto', back_populates='concert',
+                                         order_by='ConcertPhoto.position',
+                                         cascade='all, delete-orphan')
+
+
+class ConcertPhoto(Base):
+    __tablename__ = 'concert_photos'
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    concert_id = sqlalchemy.Column(sqlalchemy.Integer,
+                                   sqlalchemy.ForeignKey('concerts.id', ondelete='CASCADE'),
+                                   nullable=False)
+    position = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    file_id = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    # file_unique_id не меняется между ботами и перезагрузками, по нему сравниваются правки
+    file_unique_id = sqlalchemy.Column(sqlalchemy.String)
+
+    __table_args__ = (
+        sqlalchemy.Index('ix_concert_photos_concert_position', 'concert_id', 'position'),
+    )
+
+    concert = sqlalchemy.orm.relationship('Concert', back_populates='photos')
 
 
 class Ticket(Base):
@@ -76,9 +107,39 @@ class Ticket(Base):
     user_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('users.id'))
     concert_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('concerts.id'))
     code = sqlalchemy.Column(sqlalchemy.String, unique=True, nullable=False)
+    # Код в верхнем регистре с заменой похожих символов, по нему ищут на входе
+    code_normalized = sqlalchemy.Column(sqlalchemy.String, index=True)
     is_used = sqlalchemy.Column(sqlalchemy.Boolean, default=False)
     used_at = sqlalchemy.Column(sqlalchemy.DateTime)
+    used_by_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('users.id'))
     created_at = sqlalchemy.Column(sqlalchemy.DateTime, default=datetime.datetime.now)
 
-    user = sqlalchemy.orm.relationship("User", back_populates="tickets")
-    concert = sqlalchemy.orm.relationship("Concert", back_populates="tickets")
\ No newline at end of file
+    # Один билет на пользователя и концерт
+    __table_args__ = (
+        sqlalchemy.Index('uq_tickets_user_concert', 'user_id', 'concert_id', unique=True),
+    )
+
+    user = sqlalchemy.orm.relationship("User", back_populates="tickets", foreign_keys=[user_id])
+    concert = sqlalchemy.orm.relationship("Concert", back_populates="tickets")
+
+class StatsCounter(Base):
+    # Счетчики для экранов статистики, обновляются в тех же транзакциях,
+    # что и билеты/пользователи. name: tickets_issued и tickets_used
+    # (key -- id концерта), users_by_role (key -- роль).
+    __tablename__ = 'stats_counters'
+
+    name = sqlalchemy.Column(sqlalchemy.String(50), primary_key=True)
+    key = sqlalchemy.Column(sqlalchemy.String(100), primary_key=True)
+    value = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+
+
+class ChannelSubscription(Base):
+    # Членство в каналах из CHANNEL_USERNAMES по событиям chat_member.
+    # Ключ -- telegram_id, а не users.id: событие может прийти раньше /start.
+    __tablename__ = 'channel_subscriptions'
+
+    telegram_id = sqlalchemy.Column(sqlalchemy.BigInteger, primary_key=True)
+    channel = sqlalchemy.Column(sqlalchemy.String(100), primary_key=True)
+    is_member = sqlalchemy.Column(sqlalchemy.Boolean, nullable=False)
+    # Время события в UTC: более старое событие не перезапишет более новое
+    updated_at = sqlalchemy.Column(sqlalchemy.DateTime, nullable=False)
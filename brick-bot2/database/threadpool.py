@@ -0,0 +1,107 @@
+import asyncio
+import concurrent.futures
+import functools
+
+import sqlalchemy.orm
+
+
+class ThreadPoolSession:
+    # Повторяет интерфейс AsyncSession, но каждый вызов синхронной Session
+    # выполняется в ограниченном пуле потоков через run_in_executor.
+    # Сессия занимает слот пула с первого запроса до close(): иначе транзакция,
+    # держащая блокировку, могла бы ждать свободный поток за теми, кто ждет ее.
+
+    def __init__(self, session, executor, slots):
+        self.sync_session = session
+        self._executor = executor
+        self._slots = slots
+        self._has_slot = False
+
+    async def _run(self, func, *args, **kwargs):
+        if not self._has_slot:
+            await self._slots.acquire()
+            self._has_slot = True
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs))
+
+    def _buffered_execute(self, statement, params=None, **kwargs):
+        # Результат вычитывается целиком в потоке пула, чтобы .all()/.first()
+        # в обработчике не трогали курсор из event loop.
+        result = self.sync_session.execute(statement, params, **kwargs)
+        if not getattr(result, 'returns_rows', True):
+            return result
+        return result.freeze()()
+
+    async def execute(self, statement, params=None, **kwargs):
+        return await self._run(self._buffered_execute, statement, params, **kwargs)
+
+    async def scalars(self, statement, params=None, **kwargs):
+        result = await self.execute(statement, params, **kwargs)
+        return result.scalars()
+
+    async def scalar(self, statement, params=None, **kwargs):
+        return await self._run(self.sync_session.scalar, statement, params, **kwargs)
+
+    async def get(self, entity, ident, **kwargs):
+        return await self._run(self.sync_session.get, entity, ident, **kwargs)
+
+    async def flush(self):
+        await self._run(self.sync_session.flush)
+
+    async def commit(self):
+        await self._run(self.sync_session.commit)
+
+    async def rollback(self):
+        await self._run(self.sync_session.rollback)
+
+    async def refresh(self, instance, attribute_names=None):
+        await self._run(self.sync_session.refresh, instance, attribute_names)
+
+    async def close(self):
+        if not self._has_slot:
+            self.sync_session.close()
+            return
+        try:
+            await self._run(self.sync_session.close)
+        finally:
+            self._has_slot = False
+            self._slots.release()
+
+    def add(self, instance):
+        self.sync_session.add(instance)
+
+    def add_all(self, instances):
+        self.sync_session.add_all(instances)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+class ThreadPoolSessionmaker:
+    def __init__(self, engine, max_workers):
+        self.engine = engine
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='db')
+        self.slots = asyncio.Semaphore(max_workers)
+        self._factory = sqlalchemy.orm.sessionmaker(
+            bind=engine, expire_on_commit=False)
+
+    def __call__(self):
+        return ThreadPoolSession(self._factory(), self.executor, self.slots)
+
+    async def run_sync(self, func):
+        def work():
+            with self.engine.begin() as connection:
+                return func(connection)
+
+        async with self.slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, work)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        self.engine.dispose()
@@ -0,0 +1,96 @@
+import asyncio
+import collections
+import contextlib
+import secrets
+
+import sqlalchemy
+
+from database.models import Ticket
+
+# Без 0/O, 1/I/L и без нижнего регистра: код не перепутать на слух и на глаз
+CODE_ALPHABET = '23456789ABCDEFGHJKMNPQRSTUVWXYZ'
+CODE_LENGTH = 8
+
+# Похожие символы сводятся к одному, так же их сводит ревизия 5
+CONFUSABLES = str.maketrans({'O': '0', 'I': '1', 'L': '1'})
+
+
+def normalize_code(code):
+    return code.strip().replace(' ', '').replace('-', '').upper().translate(CONFUSABLES)
+
+
+def generate_code():
+    # secrets, а не random: коды не должны угадываться по уже выданным
+    return ''.join(secrets.choice(CODE_ALPHABET) for _ in range(CODE_LENGTH))
+
+
+class TicketCodePool:
+    # Запас заранее сгенерированных кодов, которых точно нет в tickets
+    # (с учетом нормализации).
+    # Выдача билета берет код из пула без обращения к БД, а пул пополняется
+    # пачкой в фоне, когда опускается до low_watermark.
+
+    def __init__(self, database, size, low_watermark):
+        self.database = database
+        self.size = size
+        self.low_watermark = low_watermark
+        self.fallbacks = 0
+        self._codes = collections.deque()
+        self._pending = set()
+        self._refill_task = None
+
+    def __len__(self):
+        return len(self._codes)
+
+    async def refill(self):
+        missing = self.size - len(self._codes)
+        if missing <= 0:
+            return
+
+        candidates = {generate_code() for _ in range(missing)} - self._pending
+        async with self.database.session() as session:
+            taken = set((await session.scalars(
+                sqlalchemy.select(Ticket.code_normalized).where(
+                    Ticket.code_normalized.in_(candidates)))).all())
+
+        for code in candidates - taken - self._pending:
+            self._codes.append(code)
+            self._pending.add(code)
+
+    async def _background_refill(self):
+        try:
+            await self.refill()
+        except Exception as e:
+            print(f'Ошибка пополнения пула кодов билетов: {e}')
+
+    def _schedule_refill(self):
+        if len(self._codes) > self.low_watermark:
+            return
+        if self._refill_task is not None and not self._refill_task.done():
+            return
+        self._refill_task = asyncio.create_task(self._background_refill())
+
+    def pop(self):
+        if self._codes:
+            code = self._codes.popleft()
+            self._pending.discard(code)
+        else:
+            # Пул еще не успел пополниться: код без проверки, совпадение
+            # отловит уникальный индекс и create_ticket возьмет следующий
+            self.fallbacks += 1
+            code = generate_code()
+        self._schedule_refill()
+        return code
+
+    def put_back(self, code):
+        # Код не понадобился (билет уже был выдан) -- он по-прежнему свободен
+        if code not in self._pending:
+            self._codes.appendleft(code)
+            self._pending.add(code)
+
+    async def close(self):
+        if self._refill_task is not None and not self._refill_task.done():
+            self._refill_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._refill_task
+        self._refill_task = None
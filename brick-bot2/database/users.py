@@ -0,0 +1,146 @@
+import asyncio
+import collections
+import contextlib
+
+UserInfo = collections.namedtuple(
+    'UserInfo', ['id', 'telegram_id', 'username', 'full_name', 'role', 'subscribed'])
+
+
+class UserCache:
+    # Последние активные пользователи: telegram_id -> UserInfo.
+    # Подписка и профиль пишутся сквозь кэш (update), а после смены роли запись
+    # сбрасывается (invalidate) и перечитывается из БД на следующем апдейте:
+    # права проверяются по роли, и ошибиться в ней хуже лишнего запроса.
+    # При переполнении вытесняется самый давний.
+    # Поколение telegram_id растет при каждом invalidate (и update без записи):
+    # чтение из БД, начатое до изменения, не вернет старое значение в кэш (см. set).
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+        self._generations = {}
+        self._epoch = 0
+
+    def get(self, telegram_id):
+        user = self._items.get(telegram_id)
+        if user is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items.move_to_end(telegram_id)
+        return user
+
+    def generation(self, telegram_id):
+        return self._epoch, self._generations.get(telegram_id, 0)
+
+    def set(self, user, generation=None):
+        # generation -- значение generation() до чтения user из БД
+        if generation is not None and generation != self.generation(user.telegram_id):
+            return
+        self._items[user.telegram_id] = user
+        self._items.move_to_end(user.telegram_id)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def update(self, telegram_id, **fields):
+        user = self._items.get(telegram_id)
+        if user is not None:
+            self._items[telegram_id] = user._replace(**fields)
+        else:
+            # Записи нет, но ее может сейчас читать get_user_info -- пусть
+            # прочитанное без этого изменения не попадет в кэш
+            self._generations[telegram_id] = self._generations.get(telegram_id, 0) + 1
+
+    def invalidate(self, telegram_id):
+        self._items.pop(telegram_id, None)
+        self._generations[telegram_id] = self._generations.get(telegram_id, 0) + 1
+
+    def clear(self):
+        self._items.clear()
+        self._generations.clear()
+        self._epoch += 1
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'size': len(self._items),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests * 100 if requests else 0.0,
+        }
+
+
+class UserUpdateBuffer:
+    # Изменения подписки и профиля (username, full_name), накопленные в памяти.
+    # Через interval секунд после первого изменения они уходят в БД одним
+    # пакетным UPDATE; повторные изменения того же поля до сброса схлопываются.
+    # close() отменяет ожидание, дожидается уже начатой записи и сбрасывает
+    # остаток -- вызывается при остановке.
+
+    def __init__(self, database, interval):
+        self.database = database
+        self.interval = interval
+        self.flushed = 0
+        self._pending = {}
+        self._in_flight = {}
+        self._flush_task = None
+        self._flushing = False
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, telegram_id, **fields):
+        self._pending.setdefault(telegram_id, {}).update(fields)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    def pending(self, telegram_id):
+        # Еще не записанное в БД, включая пачку, которая пишется прямо сейчас
+        return {**self._in_flight.get(telegram_id, {}), **self._pending.get(telegram_id, {})}
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        # Пачки пишутся строго по очереди (одна задача сброса), поэтому более
+        # позднее значение поля всегда ложится поверх более раннего
+        self._in_flight = pending
+        try:
+            await self.database.apply_user_updates(pending)
+        except BaseException:
+            # Вернуть несохраненное (в том числе при отмене), не затирая то,
+            # что пришло за время записи
+            for telegram_id, fields in pending.items():
+                self._pending[telegram_id] = {**fields, **self._pending.get(telegram_id, {})}
+            raise
+        finally:
+            self._in_flight = {}
+        self.flushed += len(pending)
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.interval)
+        self._flushing = True
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f'Ошибка сохранения изменений пользователей: {e}')
+        finally:
+            self._flushing = False
+            # Изменения, пришедшие во время записи, ждут следующего сброса;
+            # после close() задача уже не наша и новую не заводим
+            if self._pending and self._flush_task is asyncio.current_task():
+                self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def close(self):
+        task, self._flush_task = self._flush_task, None
+        if task is not None and not task.done():
+            if not self._flushing:
+                task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        await self.flush()
@@ -0,0 +1,64 @@
+import asyncio
+import contextlib
+import contextvars
+
+
+class SerialWriter:
+    # Очередь записей к SQLite: одна задача выполняет их строго по очереди.
+    # SQLite пускает только одного писателя, и конкурирующие транзакции
+    # иначе ждут друг друга на блокировке файла до busy_timeout.
+
+    def __init__(self):
+        self._queue = None
+        self._worker = None
+        self._closed = False
+
+    async def submit(self, func, *args, **kwargs):
+        if self._closed:
+            raise RuntimeError('Очередь записей остановлена')
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+        # Запись выполняется в контексте вызывающего (current_update_scope и
+        # т.п.), а не в контексте апдейта, который когда-то запустил worker
+        context = contextvars.copy_context()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((func, args, kwargs, context, future))
+        return await future
+
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            func, args, kwargs, context, future = item
+            if future.cancelled():
+                continue
+            try:
+                result = await context.run(asyncio.create_task, func(*args, **kwargs))
+            except asyncio.CancelledError:
+                if not future.done():
+                    future.set_exception(RuntimeError('Очередь записей остановлена'))
+                raise
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+
+    async def close(self):
+        # Новые записи не принимаются, уже поставленные выполняются до конца
+        self._closed = True
+        if self._worker is None:
+            return
+        self._queue.put_nowait(None)
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._worker
+        self._worker = None
+
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not None and not item[4].done():
+                item[4].set_exception(RuntimeError('Очередь записей остановлена'))
@@ -1,5 +1,4 @@
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from config import config
 
 
 async def confirm_use_ticket_keyboard(ticket_id):
@@ -9,15 +8,12 @@ async def confirm_use_ticket_keyboard(ticket_id):
     ]])
 
 
-async def all_groups_keyboard():
-    groups = config.groups
+async def all_groups_keyboard(groups):
     buttons = []
     count = 0
-    cnt = 1
     temp = []
-    for i in groups:
-        temp.append(InlineKeyboardButton(text=i, callback_data=f'group_{cnt}'))
-        cnt += 1
+    for group in groups:
+        temp.append(InlineKeyboardButton(text=group.name, callback_data=f'group_{group.id}'))
         count += 1
 
         if count == 3:
@@ -162,3 +158,17 @@ async def get_back_to_edit_keyboard(concert_id):
         InlineKeyboardButton(text='❌ Отмена редактирования',
                              callback_data=f'back_to_concert_card_{concert_id}'),
     ]])
+
+
+async def role_list_pagination_keyboard(role, prev_cursor, next_cursor):
+    buttons = []
+    if prev_cursor:
+        buttons.append(InlineKeyboardButton(
+            text='◀️', callback_data=f'role_page_{role}_prev_{prev_cursor}'))
+    if next_cursor:
+        buttons.append(InlineKeyboardButton(
+            text='▶️', callback_data=f'role_page_{role}_next_{next_cursor}'))
+
+    if not buttons:
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=[buttons])
@@ -0,0 +1,51 @@
+import argparse
+import asyncio
+
+from database.database_queries import database
+from database.migrations import LATEST_VERSION
+
+
+async def migrate(args):
+    applied = await database.migrate(args.target)
+    if applied:
+        print(f'Применены миграции: {", ".join(map(str, applied))}')
+    else:
+        print('Схема уже актуальна')
+
+
+async def version(args):
+    current = await database.schema_version()
+    print(f'Версия схемы: {current} (последняя: {LATEST_VERSION})')
+
+
+async def rebuild_stats(args):
+    await database.rebuild_stats_counters()
+    print('Счетчики статистики пересчитаны')
+
+
+COMMANDS = {
+    'migrate': migrate,
+    'version': version,
+    'rebuild-stats': rebuild_stats,
+}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Обслуживание базы данных бота')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = subparsers.add_parser('migrate', help='применить миграции')
+    migrate_parser.add_argument('--target', type=int, default=None,
+                                help='номер ревизии, до которой обновить схему')
+    subparsers.add_parser('version', help='показать текущую версию схемы')
+    subparsers.add_parser('rebuild-stats', help='пересчитать stats_counters по таблицам')
+
+    args = parser.parse_args()
+    try:
+        await COMMANDS[args.command](args)
+    finally:
+        await database.shutdown()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,52 @@
+import time
+
+
+class TTLCache:
+    # Словарь со сроком жизни на каждую запись. Срок задается при записи,
+    # поэтому положительные и отрицательные ответы могут жить по-разному.
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = {}
+
+    def get(self, key, default=None):
+        item = self._items.get(key)
+        if item is not None and item[1] > time.monotonic():
+            self.hits += 1
+            return item[0]
+
+        if item is not None:
+            del self._items[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl):
+        self._items.pop(key, None)
+        if len(self._items) >= self.max_size:
+            self._evict()
+        self._items[key] = (value, time.monotonic() + ttl)
+
+    def invalidate(self, key):
+        self._items.pop(key, None)
+
+    def clear(self):
+        self._items.clear()
+
+    def _evict(self):
+        now = time.monotonic()
+        for key in [key for key, (_, expires_at) in self._items.items() if expires_at <= now]:
+            del self._items[key]
+        # Живых записей все еще слишком много -- выкидываем самые старые
+        while len(self._items) >= self.max_size:
+            del self._items[next(iter(self._items))]
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'size': len(self._items),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests * 100 if requests else 0.0,
+        }
@@ -1,14 +1,173 @@
+import asyncio
+import contextlib
+import datetime
+
+from aiogram.exceptions import TelegramAPIError
+
 from config import config
+from database.database_queries import database
 
+from utils.cache import TTLCache
 from utils.initialization import bot
 
-async def check_channel_subscription(user_id):
+subscription_cache = TTLCache(config.SUBSCRIPTION_CACHE_SIZE)
+subscription_sweeps = None
+
+
+def utc_now():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def configured_channels():
+    return [channel.lower() for channel in config.CHANNEL_USERNAMES]
+
+
+async def check_channel_subscription(user_id, force=False):
     if not config.CHANNEL_USERNAMES:
         return True
-    
-    channels = config.CHANNEL_USERNAMES
-    for channel in channels:
-        member = await bot.get_chat_member(f'@{channel}', user_id)
-        if member.status not in ('member', 'administrator', 'creator'):
+
+    # force -- пользователь сам просит перепроверить: идем в Bot API мимо кэша
+    is_subscribed = None if force else subscription_cache.get(user_id)
+    if is_subscribed is not None:
+        return is_subscribed
+
+    is_subscribed = await fetch_channel_subscription(user_id, force)
+    if is_subscribed is None:
+        # Проверить не удалось: ответ по политике, и ненадолго, чтобы скоро перепроверить
+        is_subscribed = config.SUBSCRIPTION_FAIL_OPEN
+        ttl = config.SUBSCRIPTION_CACHE_NEGATIVE_TTL
+    elif is_subscribed:
+        ttl = config.SUBSCRIPTION_CACHE_TTL
+    else:
+        ttl = config.SUBSCRIPTION_CACHE_NEGATIVE_TTL
+    subscription_cache.set(user_id, is_subscribed, ttl)
+    return is_subscribed
+
+
+async def fetch_channel_subscription(user_id, force=False):
+    # Подписки ведутся по событиям chat_member, в Bot API идем только за
+    # каналами, по которым о пользователе еще ничего не известно.
+    # None -- хотя бы один канал проверить не удалось, а отказов нет
+    channels = configured_channels()
+    unknown = channels
+    if not force:
+        memberships = await database.get_channel_memberships(user_id)
+        if any(memberships.get(channel) is False for channel in channels):
             return False
-    return True
\ No newline at end of file
+        unknown = [channel for channel in channels if channel not in memberships]
+        if not unknown:
+            return True
+
+    checked_at = utc_now()
+    checked = await check_channel_members(user_id, unknown)
+    await database.save_channel_memberships(user_id, {
+        channel: is_member for channel, is_member in checked.items() if is_member is not None
+    }, checked_at)
+
+    if False in checked.values():
+        return False
+    if None in checked.values():
+        return None
+    return True
+
+
+async def check_channel_members(user_id, channels, short_circuit=True):
+    # Все каналы проверяются одновременно; с short_circuit первый отрицательный
+    # ответ решает дело, остальные запросы отменяются и в результат не попадают
+    tasks = {asyncio.create_task(check_channel_member(channel, user_id)): channel
+             for channel in channels}
+    results = {}
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                results[tasks[task]] = task.result()
+            if short_circuit and False in results.values():
+                break
+        return results
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def check_channel_member(channel, user_id):
+    try:
+        member = await asyncio.wait_for(bot.get_chat_member(f'@{channel}', user_id),
+                                        config.SUBSCRIPTION_CHECK_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f'Таймаут проверки подписки на @{channel} для {user_id}')
+        return None
+    except TelegramAPIError as e:
+        # Например, бота убрали из админов канала или канал переименован
+        print(f'Не удалось проверить подписку на @{channel} для {user_id}: {e}')
+        return None
+
+    return is_member_status(member)
+
+
+def is_member_status(member):
+    if member.status == 'restricted':
+        return member.is_member
+    return member.status in ('member', 'administrator', 'creator')
+
+
+async def on_channel_member_updated(event):
+    channel = (event.chat.username or '').lower()
+    if channel not in configured_channels():
+        return
+
+    user_id = event.new_chat_member.user.id
+    updated_at = event.date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    await database.save_channel_memberships(
+        user_id, {channel: is_member_status(event.new_chat_member)}, updated_at)
+    invalidate_subscription(user_id)
+
+
+async def reconcile_subscriptions():
+    channels = configured_channels()
+    after = None
+    while True:
+        telegram_ids = await database.get_user_telegram_ids(after)
+        if not telegram_ids:
+            return
+
+        for telegram_id in telegram_ids:
+            # Время начала проверки: событие, пришедшее во время нее, новее и не затрется
+            checked_at = utc_now()
+            checked = await check_channel_members(telegram_id, channels, short_circuit=False)
+            await database.save_channel_memberships(telegram_id, {
+                channel: is_member for channel, is_member in checked.items() if is_member is not None
+            }, checked_at)
+            invalidate_subscription(telegram_id)
+            await asyncio.sleep(config.SUBSCRIPTION_RECONCILE_DELAY)
+
+        after = telegram_ids[-1]
+
+
+async def run_subscription_sweeps():
+    while True:
+        await asyncio.sleep(config.SUBSCRIPTION_RECONCILE_INTERVAL)
+        try:
+            await reconcile_subscriptions()
+        except Exception as e:
+            print(f'Ошибка сверки подписок: {e}')
+
+
+async def start_subscription_sweeps():
+    global subscription_sweeps
+    if config.CHANNEL_USERNAMES and config.SUBSCRIPTION_RECONCILE_INTERVAL > 0:
+        subscription_sweeps = asyncio.create_task(run_subscription_sweeps())
+
+
+async def stop_subscription_sweeps():
+    global subscription_sweeps
+    if subscription_sweeps is not None:
+        subscription_sweeps.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await subscription_sweeps
+        subscription_sweeps = None
+
+
+def invalidate_subscription(user_id):
+    subscription_cache.invalidate(user_id)
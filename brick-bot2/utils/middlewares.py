@@ -0,0 +1,44 @@
+from aiogram import BaseMiddleware
+
+
+class DatabaseDebugMiddleware(BaseMiddleware):
+    def __init__(self, database):
+        self.database = database
+
+    async def __call__(self, handler, event, data):
+        async with self.database.update_scope(event.update_id):
+            return await handler(event, data)
+
+
+class UserContextMiddleware(BaseMiddleware):
+    # Пользователь, его роль и подписка определяются один раз на апдейт и
+    # попадают в обработчики аргументами user и is_subscribed.
+    # subscribed, username и full_name в users пишутся, только когда поменялись.
+
+    def __init__(self, database, check_subscription):
+        self.database = database
+        self.check_subscription = check_subscription
+
+    async def __call__(self, handler, event, data):
+        from_user = data.get('event_from_user')
+        if from_user is None or from_user.is_bot:
+            # Анонимный админ, пост от имени канала и т.п.: обработчики ждут
+            # user и is_subscribed, а пользователя для них нет -- пропускаем
+            return
+
+        # Сначала подписка: проверка может сама обновить users.subscribed
+        # (save_channel_memberships), и пользователь ниже это уже увидит
+        is_subscribed = await self.check_subscription(from_user.id)
+        user = await self.database.get_user_info(
+            from_user.id, from_user.username, from_user.full_name)
+        if is_subscribed != user.subscribed:
+            await self.database.update_user_subscription(from_user.id, is_subscribed)
+            user = user._replace(subscribed=is_subscribed)
+        if (from_user.username, from_user.full_name) != (user.username, user.full_name):
+            await self.database.update_user_profile(
+                from_user.id, from_user.username, from_user.full_name)
+            user = user._replace(username=from_user.username, full_name=from_user.full_name)
+
+        data['user'] = user
+        data['is_subscribed'] = is_subscribed
+        return await handler(event, data)